@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import time
+import torch
+import classify
+from classify import DF, autocast, enable_cpu_fast, now
+
+
+def benchmark(length, train):
+    # samples/sec of DF on random traces of length cells, forward
+    # only (as in testing) or forward and backward (as in training)
+    model = DF(2, length=length)
+    net = torch.compile(model) if classify.cpu_fast else model
+    device = torch.device("cpu")
+    optimizer = torch.optim.Adamax(params=model.parameters())
+    criterion = torch.nn.CrossEntropyLoss()
+
+    x = (torch.randint(0, 2, (args.batch_size, 1, length)) * 2 - 1).float()
+    Y = torch.randint(0, 2, (args.batch_size,))
+
+    def step():
+        if train:
+            net.train()
+            optimizer.zero_grad()
+            with autocast(device):
+                outputs = net(x)
+            criterion(outputs.float(), Y).backward()
+            optimizer.step()
+        else:
+            net.eval()
+            with torch.inference_mode(), autocast(device):
+                net(x)
+
+    # the first iterations compile in cpu-fast mode
+    for _ in range(args.warmup):
+        step()
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        step()
+    return args.iterations * args.batch_size / (time.perf_counter() - start)
+
+
+def main():
+    modes = ["eager", "cpu-fast"] if args.mode == "both" else [args.mode]
+    if "cpu-fast" in modes:
+        enable_cpu_fast(args.threads)
+    else:
+        torch.set_num_threads(args.threads)
+    print(
+        f"{now()} batch size {args.batch_size}, {args.iterations} iterations after {args.warmup} warmup, {torch.get_num_threads()} threads"
+    )
+
+    for mode in modes:
+        classify.cpu_fast = mode == "cpu-fast"
+        for length in args.lengths:
+            forward = benchmark(length, False)
+            backward = benchmark(length, True)
+            print(
+                f"{now()} {mode:>8} length {length:>4}: forward {forward:8.1f} samples/s, forward+backward {backward:8.1f} samples/s"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark DF on the CPU")
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=["eager", "cpu-fast", "both"],
+        default="both",
+        help="eager fp32, --cpu-fast, or both",
+    )
+    parser.add_argument(
+        "-l",
+        "--lengths",
+        type=int,
+        nargs="+",
+        default=[512, 5000],
+        help="trace lengths",
+    )
+    parser.add_argument(
+        "-b", "--batch-size", type=int, default=classify.BATCH_SIZE, help="batch size"
+    )
+    parser.add_argument(
+        "-n", "--iterations", type=int, default=10, help="timed iterations"
+    )
+    parser.add_argument(
+        "-w", "--warmup", type=int, default=3, help="untimed iterations first"
+    )
+    parser.add_argument(
+        "-t", "--threads", type=int, default=os.cpu_count(), help="torch threads"
+    )
+    args = parser.parse_args()
+    main()
@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
 import numpy as np
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torch.utils import data
-from datetime import datetime
 import argparse
 import os
+import tempfile
+from classify import (
+    circuit_width,
+    BATCH_SIZE,
+    EPOCHS,
+    FOLDS,
+    PATIENCE,
+    dataset_path,
+    enable_cpu_fast,
+    load_dataset,
+    now,
+    prefix_half,
+    run_folds,
+    save_model,
+    stack,
+)
 
 args = argparse.ArgumentParser()
-args.add_argument("dataset1", help="first dataset")
+args.add_argument(
+    "dataset1", help="first dataset (a trace file or FILE.hdf5:DATASET:KINDS)"
+)
 args.add_argument("dataset2", help="second dataset")
 args.add_argument("-l", "--length", help="length of the traces", type=int, default=5000)
 args.add_argument(
@@ -19,49 +33,100 @@ args.add_argument(
     default=0.0,
     help="open world mode with given train split probability",
 )
+args.add_argument(
+    "-fw",
+    "--fold-workers",
+    type=int,
+    default=1,
+    help="number of folds to run in parallel processes (CPU only)",
+)
+args.add_argument(
+    "-s",
+    "--seed",
+    type=int,
+    default=None,
+    help="base seed, fold k uses seed + k (by default the one saved in the fold dir, else random)",
+)
+args.add_argument(
+    "-d",
+    "--fold-dir",
+    default=None,
+    help="directory for fold checkpoints (to resume from) and test predictions",
+)
+args.add_argument(
+    "--cpu-fast",
+    action="store_true",
+    help="torch.compile, bfloat16 autocast where supported and explicit threads",
+)
+args.add_argument(
+    "-t",
+    "--threads",
+    type=int,
+    default=None,
+    help="torch threads per fold (default: cores / fold workers)",
+)
+args.add_argument(
+    "-p",
+    "--prefixes",
+    type=int,
+    nargs="+",
+    default=None,
+    help="also test the trained models on the first N cells of every test trace, for each N",
+)
+args.add_argument(
+    "--lazy",
+    action="store_true",
+    help="read FILE.hdf5:DATASET:KINDS datasets block by block while training, not into memory",
+)
+args.add_argument(
+    "--per-circuit",
+    action="store_true",
+    help="truncate both circuits of OL samples (general and rend) to each prefix",
+)
+args.add_argument(
+    "-m",
+    "--save-model",
+    default=None,
+    help="save the model of the first fold here, for score-traces.py",
+)
 args = args.parse_args()
 
-BATCH_SIZE = 128
-EPOCHS = 200
-FOLDS = 10
-
-
-def update_dataset(name, filename, labels, dataset, tags, LENGTH=5000):
-    npz = np.load(filename, allow_pickle=True)
-    # labels in the npz file is uuid -> tag
-    t = npz["labels"].item()
-    tags.update(t)
-    # update labels to uuid -> name
-    for uuid in t:
-        labels[uuid] = name
-    d = npz["dataset"].item()
-    for uuid in d:
-        # base data is always 5000 long, since vanilla DF expects that
-        data = np.zeros((1, 5000), dtype=np.float32)
-        n = min(LENGTH, d[uuid].shape[1])
-        data[0, :n] = d[uuid][0, :n]
-        d[uuid] = data
-
-    dataset.update(d)
-
 
 def main():
-    global BATCH_SIZE
-    if not os.path.exists(args.dataset1):
+    if not os.path.exists(dataset_path(args.dataset1)):
         print(f"{args.dataset1} does not exist")
         return
-    if not os.path.exists(args.dataset2):
+    if not os.path.exists(dataset_path(args.dataset2)):
         print(f"{args.dataset2} does not exist")
         return
-
-    # labels is uuid -> label
-    # dataset is uuid -> extracted trace
-    # tags is uuid -> tag
-    labels, dataset, tags = {}, {}, {}
-    update_dataset(0, args.dataset1, labels, dataset, tags, args.length)
-    dataset1_len = len(labels)
-    update_dataset(1, args.dataset2, labels, dataset, tags, args.length)
-    dataset2_len = len(labels) - dataset1_len
+    half = None
+    if args.prefixes:
+        try:
+            half = prefix_half(
+                [args.dataset1, args.dataset2], args.length, args.per_circuit
+            )
+        except ValueError as e:
+            print(f"{e}, see --per-circuit")
+            return
+    if args.cpu_fast:
+        enable_cpu_fast(args.threads or max(1, os.cpu_count() // args.fold_workers))
+    elif args.threads:
+        torch.set_num_threads(args.threads)
+
+    # both datasets stacked once: samples, labels (0 or 1) and tags by sample
+    samples1, tags1 = load_dataset(args.dataset1, args.length, args.lazy)
+    samples2, tags2 = load_dataset(args.dataset2, args.length, args.lazy)
+    dataset1_len, dataset2_len = len(samples1), len(samples2)
+    dataset = stack([samples1, samples2])
+    del samples1, samples2
+    labels = torch.cat(
+        (
+            torch.zeros(dataset1_len, dtype=torch.long),
+            torch.ones(dataset2_len, dtype=torch.long),
+        )
+    )
+    tags = tags1 + tags2
+    index = torch.arange(len(dataset))
 
     assert len(labels) == len(dataset) == len(tags)
     print(
@@ -80,297 +145,83 @@ def main():
             f"{now()} 'OPEN WORLD' MODE: splitting by tag, training probability {args.open_world}"
         )
 
-    results = []
+    # the base seed is kept in the fold dir, so that a rerun without --seed
+    # gets the same splits and resumes from their checkpoints
+    seed_file = os.path.join(args.fold_dir, "seed") if args.fold_dir else None
+    if args.seed is None and seed_file and os.path.exists(seed_file):
+        with open(seed_file) as f:
+            args.seed = int(f.read())
+        print(f"{now()} reusing the base seed of {args.fold_dir}")
+    if args.seed is None:
+        args.seed = np.random.randint(2**31)
+    if seed_file:
+        os.makedirs(args.fold_dir, exist_ok=True)
+        with open(seed_file, "w") as f:
+            f.write(f"{args.seed}\n")
+    print(f"{now()} using base seed {args.seed}")
 
     print(
-        f"{now()} training with {EPOCHS} epochs, batch size {BATCH_SIZE}, patience 10"
+        f"{now()} training with {EPOCHS} epochs, batch size {BATCH_SIZE}, patience {PATIENCE}"
     )
     if torch.cuda.is_available():
         print(f"{now()} using {torch.cuda.get_device_name(0)}")
     print(f"{now()} we do {FOLDS}-fold cross validation with a 8:1:1 split")
-    for k in range(FOLDS):
-        print(f"{now()} running fold {k}...")
-
-        # train, validation, test lists with uuids
-        train, valid, test = [], [], []
-
-        if args.open_world > 0.0:
-            print(f"{now()} using open world mode, stratified by tag")
-            # split by tag
-            for tag in set(tags.values()):
-                uuids = [uuid for uuid in tags if tags[uuid] == tag]
-
-                # with some probability, add all uuids to train, else test
-                if np.random.rand() < args.open_world:
-                    train.extend(uuids)
-                else:
-                    test.extend(uuids)
-
-        else:
-            print(f"{now()} using closed world mode, stratified by label")
-            # random split, 80% train, 10% validation, 10% test, stratified by label
-            for label in set(labels.values()):
-                uuids = [uuid for uuid in labels if labels[uuid] == label]
-                np.random.shuffle(uuids)
-                train.extend(uuids[: int(len(uuids) * 0.8)])
-                valid.extend(uuids[int(len(uuids) * 0.8) : int(len(uuids) * 0.9)])
-                test.extend(uuids[int(len(uuids) * 0.9) :])
 
-        print(f"{now()} train {len(train)}, valid {len(valid)}, test {len(test)}")
-
-        results.append(run_df(train, valid, test, dataset, labels, tags))
+    # the best weights of every fold are in its final checkpoint, kept in a
+    # temporary directory if there is no fold dir
+    fold_dir = args.fold_dir
+    if args.save_model and fold_dir is None:
+        tmp = tempfile.TemporaryDirectory()
+        fold_dir = tmp.name
+    results = run_folds(
+        (dataset, index, labels, tags),
+        args.seed,
+        args.open_world,
+        args.fold_workers,
+        fold_dir,
+        args.prefixes,
+        args.threads,
+        half,
+    )
 
-    accuracy = [r[0] for r in results]
-    fpr = [r[1] for r in results]
+    accuracy = [r["accuracy"] for r in results]
+    fpr = [r["fpr"] for r in results]
+    roc_auc = [r["roc_auc"] for r in results]
 
     print(f"{now()} done, {FOLDS}-fold cross validation results")
     print(
         f"{now()} accuracy mean: {np.mean(accuracy):.4f}, std: {np.std(accuracy):.4f}"
     )
     print(f"{now()} fpr mean: {np.mean(fpr):.4f}, std: {np.std(fpr):.4f}")
-
-
-def run_df(train, valid, test, dataset, labels, tags):
-    model = DF(2)
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    if torch.cuda.is_available():
-        model.cuda()
-
-    train_gen = data.DataLoader(
-        Dataset(train, dataset, labels),
-        batch_size=BATCH_SIZE,
-        shuffle=True,
-        drop_last=True,
-    )
-
-    optimizer = torch.optim.Adamax(params=model.parameters())
-    criterion = torch.nn.CrossEntropyLoss()
-    best_loss = float("inf")
-    patience = 10
-
-    for epoch in range(EPOCHS):
-        # training
-        model.train()
-        torch.set_grad_enabled(True)
-        running_loss = 0.0
-        n = 0
-        for x, Y in train_gen:
-            x, Y = x.to(device), Y.to(device)
-            optimizer.zero_grad()
-            outputs = model(x)
-            loss = criterion(outputs, Y)
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item()
-            n += 1
-        if running_loss < best_loss:
-            best_loss = running_loss
-            patience = 10
-        else:
-            patience -= 1
-            if patience == 0:
-                print("\tearly stopping, patience 10 reached")
-                break
-
-    # testing
-    testing_gen = data.DataLoader(
-        Dataset(test, dataset, labels), batch_size=BATCH_SIZE, drop_last=True
-    )
-    model.eval()
-    torch.set_grad_enabled(False)
-    predictions = []
-    p_labels = []
-    for x, Y in testing_gen:
-        x = x.to(device)
-        outputs = model(x)
-        index = F.softmax(outputs, dim=1).data.cpu().numpy()
-        predictions.extend(index.tolist())
-        p_labels.extend(Y.data.numpy().tolist())
-    predictions = np.array(predictions)
-    p_labels = np.array(p_labels)
-
-    # we made predictions, stored in the predictions array, and true labels in p_labels
-    fp = 0
-    tp = 0
-    fn = 0
-    tn = 0
-    for i in range(len(predictions)):
-        predicted = np.argmax(predictions[i])
-        correct = p_labels[i]
-        if predicted == 0 and correct == 1:
-            fp += 1
-        elif predicted == 0 and correct == 0:
-            tp += 1
-        elif predicted == 1 and correct == 0:
-            fn += 1
-        elif predicted == 1 and correct == 1:
-            tn += 1
-        else:
-            print(f"{now()} unexpected prediction {predicted} for {correct}")
-
-    fpr = fp / (fp + tn)
-    tpr = tp / (tp + fn)
-    fnr = fn / (fn + tp)
-    tnr = tn / (tn + fp)
-    accuracy = (tp + tn) / (tp + tn + fp + fn)
-    print(f"{now()} fold fpr {fpr:.4f}, tpr {tpr:.4f}, fnr {fnr:.4f}, tnr {tnr:.4f}")
-
-    return (accuracy, fpr)
-
-
-# from https://github.com/Xinhao-Deng/Website-Fingerprinting-Library/blob/master/WFlib/models/DF.py
-class ConvBlock(nn.Module):
-    def __init__(
-        self,
-        in_channels,
-        out_channels,
-        kernel_size,
-        stride,
-        pool_size,
-        pool_stride,
-        dropout_p,
-        activation,
-    ):
-        super(ConvBlock, self).__init__()
-        padding = (
-            kernel_size // 2
-        )  # Calculate padding to keep the output size same as input size
-        # Define a convolutional block consisting of two convolutional layers,
-        # each followed by batch normalization and activation
-        self.block = nn.Sequential(
-            nn.Conv1d(
-                in_channels,
-                out_channels,
-                kernel_size,
-                stride,
-                padding=padding,
-                bias=False,
-            ),  # First convolutional layer
-            nn.BatchNorm1d(out_channels),  # Batch normalization layer
-            activation(inplace=True),  # Activation function (e.g., ELU or ReLU)
-            nn.Conv1d(
-                out_channels,
-                out_channels,
-                kernel_size,
-                stride,
-                padding=padding,
-                bias=False,
-            ),  # Second convolutional layer
-            nn.BatchNorm1d(out_channels),  # Batch normalization layer
-            activation(inplace=True),  # Activation function
-            nn.MaxPool1d(
-                pool_size, pool_stride, padding=0
-            ),  # Max pooling layer to downsample the input
-            nn.Dropout(p=dropout_p),  # Dropout layer for regularization
-        )
-
-    def forward(self, x):
-        # Pass the input through the convolutional block
-        return self.block(x)
-
-
-# from https://github.com/Xinhao-Deng/Website-Fingerprinting-Library/blob/master/WFlib/models/DF.py
-class DF(nn.Module):
-    def __init__(self, num_classes, num_tab=1):
-        super(DF, self).__init__()
-
-        # Configuration parameters for the convolutional blocks
-        filter_num = [32, 64, 128, 256]  # Number of filters for each block
-        kernel_size = 8  # Kernel size for convolutional layers
-        conv_stride_size = 1  # Stride size for convolutional layers
-        pool_stride_size = 4  # Stride size for max pooling layers
-        pool_size = 8  # Kernel size for max pooling layers
-        length_after_extraction = (
-            18  # Length of the feature map after the feature extraction part
+    print(f"{now()} roc auc mean: {np.mean(roc_auc):.4f}, std: {np.std(roc_auc):.4f}")
+    for i, p in enumerate(args.prefixes or []):
+        accuracy = [r["by_prefix"][i]["accuracy"] for r in results]
+        fpr = [r["by_prefix"][i]["fpr"] for r in results]
+        print(
+            f"{now()} first {p} cells{' per circuit' if half else ''}: accuracy mean {np.mean(accuracy):.4f}, std {np.std(accuracy):.4f}, fpr mean {np.mean(fpr):.4f}, std {np.std(fpr):.4f}"
         )
 
-        # Define the feature extraction part of the network using a sequential
-        # container with ConvBlock instances
-        self.feature_extraction = nn.Sequential(
-            ConvBlock(
-                1,
-                filter_num[0],
-                kernel_size,
-                conv_stride_size,
-                pool_size,
-                pool_stride_size,
-                0.1,
-                nn.ELU,
-            ),  # Block 1
-            ConvBlock(
-                filter_num[0],
-                filter_num[1],
-                kernel_size,
-                conv_stride_size,
-                pool_size,
-                pool_stride_size,
-                0.1,
-                nn.ReLU,
-            ),  # Block 2
-            ConvBlock(
-                filter_num[1],
-                filter_num[2],
-                kernel_size,
-                conv_stride_size,
-                pool_size,
-                pool_stride_size,
-                0.1,
-                nn.ReLU,
-            ),  # Block 3
-            ConvBlock(
-                filter_num[2],
-                filter_num[3],
-                kernel_size,
-                conv_stride_size,
-                pool_size,
-                pool_stride_size,
-                0.1,
-                nn.ReLU,
-            ),  # Block 4
+    if args.save_model:
+        # always the first fold: the folds' validation losses (training
+        # losses in open world mode) are on different samples and not
+        # comparable, and picking by test metrics would bias its result
+        k = 0
+        checkpoint = torch.load(
+            os.path.join(fold_dir, f"fold-{k}.pt"), map_location="cpu"
         )
-
-        # Define the classifier part of the network
-        self.classifier = nn.Sequential(
-            nn.Flatten(),  # Flatten the tensor to a vector
-            nn.Linear(
-                filter_num[3] * length_after_extraction, 512, bias=False
-            ),  # Fully connected layer
-            nn.BatchNorm1d(512),  # Batch normalization layer
-            nn.ReLU(inplace=True),  # ReLU activation function
-            nn.Dropout(p=0.7),  # Dropout layer for regularization
-            nn.Linear(512, 512, bias=False),  # Fully connected layer
-            nn.BatchNorm1d(512),  # Batch normalization layer
-            nn.ReLU(inplace=True),  # ReLU activation function
-            nn.Dropout(p=0.5),  # Dropout layer for regularization
-            nn.Linear(512, num_classes),  # Output layer
+        save_model(
+            args.save_model,
+            checkpoint["model"],
+            args.length,
+            [os.path.basename(args.dataset1), os.path.basename(args.dataset2)],
+            fold=k,
+            seed=args.seed + k,
+            result=results[k],
+            # cells per circuit of samples of two circuits (OL), else None
+            circuit_width=circuit_width(args.dataset1, args.length)
+            or circuit_width(args.dataset2, args.length),
         )
-
-    def forward(self, x):
-        # Pass the input through the feature extraction part
-        x = self.feature_extraction(x)
-
-        # Pass the output through the classifier part
-        x = self.classifier(x)
-
-        return x
-
-
-class Dataset(data.Dataset):
-    def __init__(self, ids, dataset, labels):
-        self.ids = ids
-        self.dataset = dataset
-        self.labels = labels
-
-    def __len__(self):
-        return len(self.ids)
-
-    def __getitem__(self, index):
-        ID = self.ids[index]
-        return self.dataset[ID], self.labels[ID]
-
-
-def now():
-    return datetime.now().strftime("%H:%M:%S")
+        print(f"{now()} saved the model of fold {k} to {args.save_model}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+import os
+import numpy as np
+from tqdm import tqdm
+from circuitstore import list_tag_files, load_tag
+from resultcache import file_digest
+from traces import count_cells
+
+# A table of per-circuit features of every tag file of a dataset directory,
+# computed in one pass and saved to <dataset>/index.npz, so that scripts can
+# select circuits without featurizing them. Circuit i (tag files in order,
+# circuits in file order) has columns:
+#   tag_file  its tag file, into files (and tags, the tag of every file)
+#   fetch     fetch number
+#   kind      circuit kind (KIND_*)
+#   domain    int32 id of its domain, into domains (sorted, unique)
+#   dir       whether it is a directory circuit
+#   cells     its number of cells in traces, see count_cells()
+# The circuits of file j are rows offsets[j]:offsets[j + 1], and digests[j] is
+# the content digest of file j (for resultcache). Domains are selected by id,
+# see domain_ids(). When tag files are added, removed or modified, the index is
+# updated, reading only those files, and it is rebuilt when its VERSION
+# changes.
+INDEX = "index.npz"
+VERSION = 3
+COLUMNS = ["fetch", "kind", "domain", "dir", "cells"]
+
+
+def index_path(dataset):
+    return os.path.join(dataset, INDEX)
+
+
+def tag_features(path):
+    # (tag, columns) of the circuits of one tag file, and its digest
+    tag, circuits = load_tag(path)
+    # with the domains of the tag and the domain of every circuit as an id
+    # into them, mapped to the ids of the dataset in build()
+    cells, is_dir = count_cells(circuits)
+    domains, domain = np.unique(circuits["domain"], return_inverse=True)
+    return tag, dict(
+        fetch=np.asarray(circuits["fetch"]),
+        kind=np.asarray(circuits["kind"]),
+        domain=domain.astype(np.int32),
+        dir=is_dir,
+        cells=cells.astype(np.int32),
+        domains=domains,
+        digest=file_digest(path),
+    )
+
+
+def reuse_features(index, j):
+    # tag_features() of tag file j of an index, its domain ids mapped back to
+    # the domains of the tag
+    c = features(index, j)
+    domains, c["domain"] = np.unique(c["domain"], return_inverse=True)
+    c.update(
+        domain=c["domain"].astype(np.int32),
+        domains=index["domains"][domains],
+        digest=index["digests"][j],
+    )
+    return index["tags"][j], c
+
+
+def file_stats(dataset, files):
+    # (mtime, size) of every tag file, a .circuits directory by its cells
+    stats = []
+    for f in files:
+        p = os.path.join(dataset, f)
+        if os.path.isdir(p):
+            p = os.path.join(p, "cells.npy")
+        s = os.stat(p)
+        stats.append((s.st_mtime_ns, s.st_size))
+    return np.array(stats, dtype=np.int64).reshape(-1, 2)
+
+
+def build(dataset, executor=None, previous=None):
+    # index of a dataset, spread over the executor if given, with the
+    # features of the files unchanged since a previous index reused
+    files = list_tag_files(dataset)
+    stats = file_stats(dataset, files)
+    results = [None] * len(files)
+    if previous is not None and previous.get("version") == VERSION:
+        unchanged = {
+            (f, tuple(s)): j
+            for j, (f, s) in enumerate(zip(previous["files"], previous["stats"]))
+        }
+        for i, (f, s) in enumerate(zip(files, stats)):
+            j = unchanged.get((f, tuple(s)))
+            if j is not None:
+                results[i] = reuse_features(previous, j)
+    todo = [i for i, r in enumerate(results) if r is None]
+    paths = [os.path.join(dataset, files[i]) for i in todo]
+    for i, r in zip(
+        todo,
+        tqdm(
+            executor.map(tag_features, paths) if executor else map(tag_features, paths),
+            total=len(paths),
+        ),
+    ):
+        results[i] = r
+    # the domain vocabulary of the dataset
+    domains = np.unique(np.concatenate([c["domains"] for _, c in results] or [[b""]]))
+    for _, c in results:
+        c["domain"] = np.searchsorted(domains, c["domains"])[c["domain"]].astype(
+            np.int32
+        )
+    index = {
+        name: np.concatenate([c[name] for _, c in results])
+        if results
+        else np.zeros(0, dtype=np.int64)
+        for name in COLUMNS
+    }
+    counts = [len(c["kind"]) for _, c in results]
+    index.update(
+        version=VERSION,
+        domains=domains,
+        files=np.array(files),
+        tags=np.array([tag for tag, _ in results]),
+        stats=stats,
+        digests=np.array([c["digest"] for _, c in results], dtype="U64"),
+        tag_file=np.repeat(np.arange(len(files), dtype=np.int32), counts),
+        offsets=np.concatenate(([0], np.cumsum(counts))),
+    )
+    return index
+
+
+def is_current(index, dataset):
+    files = list_tag_files(dataset)
+    return (
+        index.get("version") == VERSION
+        and list(index["files"]) == files
+        and np.array_equal(index["stats"], file_stats(dataset, files))
+    )
+
+
+def load(dataset, executor=None):
+    # the index of a dataset as a dict of columns, built (again) if needed
+    p = index_path(dataset)
+    index = None
+    if os.path.exists(p):
+        with np.load(p) as npz:
+            index = {name: npz[name] for name in npz.files}
+        if is_current(index, dataset):
+            return index
+    print(f"indexing {dataset}...")
+    index = build(dataset, executor, index)
+    # write to a temporary file and rename, an existing index is complete
+    np.savez(f"{p}.tmp.npz", **index)
+    os.replace(f"{p}.tmp.npz", p)
+    return index
+
+
+def domain_ids(index, domains):
+    # ids of the given domains, those in the vocabulary of index
+    return np.flatnonzero(np.isin(index["domains"], domains)).astype(np.int32)
+
+
+def features(index, i):
+    # the columns of the circuits of tag file i
+    s = slice(index["offsets"][i], index["offsets"][i + 1])
+    return {name: index[name][s] for name in COLUMNS}
@@ -0,0 +1,120 @@
+import os
+import pickle
+import shutil
+import numpy as np
+
+# A tag is stored as a directory with one .npy file per metadata column, the
+# cells of all circuits back to back in cells.npy and an offset table into the
+# cells in offsets.npy (circuit i has cells offsets[i]:offsets[i+1]). Files are
+# opened with mmap_mode="r", so nothing is deserialized or copied on load.
+SUFFIX = ".circuits"
+PICKLE_SUFFIX = ".pickle"
+
+
+class Circuits:
+    # Columnar circuits, indexed like the structured arrays in the pickles:
+    # circuits["fetch"] is a column, circuits[mask] or circuits[a:b] is a
+    # subset sharing the same cells, and circuits[i] is one circuit as a dict.
+    def __init__(self, columns, cells, starts, ends):
+        self.columns = columns
+        self.cells = cells
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        if isinstance(key, (int, np.integer)):
+            c = {name: col[key] for name, col in self.columns.items()}
+            for name, v in c.items():
+                # plain bytes, as read from the variable length strings in hdf5
+                if isinstance(v, np.bytes_):
+                    c[name] = bytes(v)
+            c["cells"] = self.cells[self.starts[key] : self.ends[key]]
+            return c
+        return Circuits(
+            {name: col[key] for name, col in self.columns.items()},
+            self.cells,
+            self.starts[key],
+            self.ends[key],
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return self.ends - self.starts
+
+
+def from_records(circuits):
+    # structured array with a "cells" field -> Circuits
+    columns = {}
+    for name in circuits.dtype.names:
+        if name == "cells":
+            continue
+        col = circuits[name]
+        if col.dtype == object:
+            # variable length strings in hdf5, fixed width is memory-mappable
+            col = np.array(col.tolist())
+        elif col.dtype.metadata:
+            # drop h5py metadata, it cannot be saved to .npy
+            col = col.astype(col.dtype.str)
+        columns[name] = col
+
+    cells = circuits["cells"]
+    if cells.dtype == object:
+        # variable length cells in hdf5
+        lengths = np.array([len(c) for c in cells], dtype=np.int64)
+        if len(cells) > 0:
+            cells = np.concatenate(list(cells))
+    else:
+        # fixed number of cells per circuit
+        lengths = np.full(len(cells), cells.shape[1], dtype=np.int64)
+        cells = cells.reshape(-1)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return Circuits(columns, cells, offsets[:-1], offsets[1:])
+
+
+def save_tag(path, circuits):
+    # write to a temporary directory and rename when complete
+    c = from_records(circuits)
+    tmp = f"{path}.tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.mkdir(tmp)
+    for name, col in c.columns.items():
+        np.save(os.path.join(tmp, f"{name}.npy"), col)
+    np.save(os.path.join(tmp, "cells.npy"), c.cells)
+    np.save(os.path.join(tmp, "offsets.npy"), np.append(c.starts, c.ends[-1:]))
+    os.replace(tmp, path)
+
+
+def load_tag(path):
+    # returns (tag, Circuits) for a .circuits directory or a .pickle file
+    if path.endswith(PICKLE_SUFFIX):
+        with open(path, "rb") as f:
+            tag, circuits = pickle.load(f)
+        return tag, from_records(circuits)
+
+    columns = {}
+    for f in sorted(os.listdir(path)):
+        if f.endswith(".npy"):
+            columns[f[:-4]] = np.load(os.path.join(path, f), mmap_mode="r")
+    cells = columns.pop("cells")
+    offsets = columns.pop("offsets")
+    return columns["tag"][0], Circuits(columns, cells, offsets[:-1], offsets[1:])
+
+
+def list_tag_files(dir):
+    # sorted tag files in dir, in either format, preferring .circuits
+    files = {}
+    for f in sorted(os.listdir(dir)):
+        stem, ext = os.path.splitext(f)
+        if ext == SUFFIX or (ext == PICKLE_SUFFIX and stem not in files):
+            files[stem] = f
+    return sorted(files.values())
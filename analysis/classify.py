@@ -0,0 +1,817 @@
+import copy
+import hashlib
+import multiprocessing
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import hdf5dataset
+import metrics
+import tracefile
+
+BATCH_SIZE = 128
+EPOCHS = 200
+FOLDS = 10
+# epochs without a lower validation loss before stopping early
+PATIENCE = 10
+
+# opt-in CPU speedups, see enable_cpu_fast()
+cpu_fast = False
+
+# samples unpacked from trace files at a time
+LOAD_CHUNK = 65536
+
+
+def dataset_path(filename):
+    # the file of a dataset, the hdf5 file of an hdf5dataset spec
+    return filename.split(":")[0] if hdf5dataset.is_spec(filename) else filename
+
+
+class Samples:
+    # Samples of width cells, kept compact: sample i is the concatenation of
+    # rows pairs[i, 0] and pairs[i, 1] of the int8 rows (of ceil(width / 2)
+    # cells each), truncated to width. The samples of a trace file with pairs
+    # (see tracefile) share its general and rend halves, other samples are
+    # split into two rows of their own. get() builds a batch with two
+    # index_selects on the device, without materializing all samples.
+    def __init__(self, rows, pairs, width):
+        self.rows = rows
+        self.pairs = pairs
+        self.width = width
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def to(self, device):
+        return Samples(self.rows.to(device), self.pairs.to(device), self.width)
+
+    def get(self, index):
+        # int8 (len(index), width) samples
+        p = self.pairs.index_select(0, index)
+        x = torch.cat(
+            (self.rows.index_select(0, p[:, 0]), self.rows.index_select(0, p[:, 1])),
+            dim=1,
+        )
+        return x[:, : self.width]
+
+    def shuffle(self, index):
+        # index in a random order
+        return index[torch.randperm(len(index))]
+
+    def read_order(self, index):
+        # index in the order to read it in, any order for samples in memory
+        return index
+
+
+class LazySamples:
+    # The samples of an hdf5dataset.HDF5Traces, read and featurized block by
+    # block on demand, like Samples otherwise. shuffle() and read_order() read
+    # each block once per pass, with the traces of recent blocks cached.
+    def __init__(self, traces, device=None):
+        self.traces = traces
+        self.width = traces.length
+        self.device = device or torch.device("cpu")
+
+    def __len__(self):
+        return len(self.traces)
+
+    def to(self, device):
+        return LazySamples(self.traces, device)
+
+    def get(self, index):
+        # int8 (len(index), width) samples
+        x = self.traces.get(index.cpu().numpy())
+        return torch.from_numpy(x).to(self.device)
+
+    def shuffle(self, index):
+        # index in a random order, see hdf5dataset.block_shuffle()
+        blocks = self.traces.sample_blocks[index.cpu().numpy()]
+        order = hdf5dataset.block_shuffle(blocks, self.traces.cache_blocks)
+        return index[torch.from_numpy(order).to(index.device)]
+
+    def read_order(self, index):
+        # index by block, in its order within a block
+        blocks = self.traces.sample_blocks[index.cpu().numpy()]
+        order = np.argsort(blocks, kind="stable")
+        return index[torch.from_numpy(order).to(index.device)]
+
+
+class StackedSamples:
+    # Samples and LazySamples of several datasets one after another, see
+    # stack(). Shuffles keep the order of each part, see the parts' shuffle(),
+    # and interleave the parts randomly.
+    def __init__(self, parts):
+        self.parts = parts
+        self.width = parts[0].width
+        self.offsets = np.cumsum([0] + [len(p) for p in parts])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def to(self, device):
+        return StackedSamples([p.to(device) for p in self.parts])
+
+    def part(self, index):
+        # the part of every sample in index
+        starts = torch.tensor(self.offsets[1:-1], device=index.device)
+        return torch.bucketize(index, starts, right=True)
+
+    def get(self, index):
+        part = self.part(index)
+        x = torch.zeros((len(index), self.width), dtype=torch.int8, device=index.device)
+        for i, p in enumerate(self.parts):
+            at = part == i
+            if at.any():
+                x[at] = p.get(index[at] - int(self.offsets[i]))
+        return x
+
+    def shuffle(self, index):
+        part = self.part(index)
+        # the part of every position, in a random arrangement
+        arrangement = part[torch.randperm(len(index))]
+        shuffled = torch.empty_like(index)
+        for i, p in enumerate(self.parts):
+            offset = int(self.offsets[i])
+            shuffled[arrangement == i] = p.shuffle(index[part == i] - offset) + offset
+        return shuffled
+
+    def read_order(self, index):
+        part = self.part(index)
+        return torch.cat(
+            [
+                p.read_order(index[part == i] - int(self.offsets[i]))
+                + int(self.offsets[i])
+                for i, p in enumerate(self.parts)
+            ]
+        )
+
+
+def half_width(width):
+    # cells per row of Samples of width cells
+    return -(-width // 2)
+
+
+def from_dense(x, width):
+    # Samples of int8 (n, width) traces, each split into two rows
+    half = half_width(width)
+    if 2 * half != width:
+        x = fit(x, 2 * half)
+    pairs = torch.arange(2 * len(x)).reshape(-1, 2)
+    return Samples(torch.from_numpy(x.reshape(-1, half)), pairs, width)
+
+
+def stack(samples):
+    # the Samples of several datasets, one after another, or StackedSamples
+    # with any LazySamples
+    if not all(isinstance(s, Samples) for s in samples):
+        return StackedSamples(samples)
+    rows, pairs, offset = [], [], 0
+    for s in samples:
+        rows.append(s.rows)
+        pairs.append(s.pairs + offset)
+        offset += len(s.rows)
+    return Samples(torch.cat(rows), torch.cat(pairs), samples[0].width)
+
+
+def circuit_width(filename, length):
+    # cells per circuit if the samples of a dataset (of length cells) are two
+    # circuits, general and rend (the trace files of extract-ol.py, see
+    # tracefile, and general+rend hdf5dataset specs), else None
+    if hdf5dataset.is_spec(filename):
+        return half_width(length) if ":general+rend" in filename else None
+    if not tracefile.is_trace_file(filename):
+        return None
+    tf = tracefile.TraceFile(filename)
+    if tf.circuit_width is None and tf.pairs is not None:
+        # pairs files of before circuit_width
+        return tf.width
+    return tf.circuit_width
+
+
+def prefix_half(filenames, length, per_circuit=False):
+    # The half of score_prefixes() for prefixes of samples of the datasets:
+    # with per_circuit, the cells per circuit of datasets of two circuits,
+    # else None. Raises ValueError for prefixes of whole samples of two
+    # circuits, which would zero the rend circuit of most of them.
+    widths = {circuit_width(f, length) for f in filenames}
+    if not per_circuit:
+        if widths != {None}:
+            raise ValueError("prefixes of samples of two circuits need per circuit")
+        return None
+    if len(widths) != 1 or None in widths:
+        raise ValueError("per circuit prefixes need datasets of two circuits")
+    return widths.pop()
+
+
+def load_dataset(filename, LENGTH=5000, lazy=False):
+    # all samples of a file as Samples of LENGTH cells (truncated or zero
+    # padded), and their tags. The pairs of a trace file with pairs of
+    # LENGTH / 2 cells each stay compact, see Samples. filename can also
+    # select circuits straight from the hdf5 file, see
+    # hdf5dataset.from_spec(), read on demand with lazy (see LazySamples).
+    if hdf5dataset.is_spec(filename):
+        traces = hdf5dataset.from_spec(filename, LENGTH)
+        if lazy:
+            return LazySamples(traces), list(traces.tags)
+        if traces.pairs is not None:
+            rows = traces.circuit_traces(np.arange(len(traces.rows)))
+            pairs = torch.from_numpy(traces.pairs.astype(np.int64))
+            return Samples(torch.from_numpy(rows), pairs, LENGTH), list(traces.tags)
+        x = traces.get(np.arange(len(traces)))
+        return from_dense(x, LENGTH), list(traces.tags)
+
+    if tracefile.is_trace_file(filename):
+        tf = tracefile.TraceFile(filename)
+        if tf.pairs is not None and tf.width == half_width(LENGTH):
+            rows = np.zeros((len(tf.traces), tf.width), dtype=np.int8)
+            for start in range(0, len(rows), LOAD_CHUNK):
+                end = min(start + LOAD_CHUNK, len(rows))
+                rows[start:end] = tracefile.unpack(tf.traces[start:end], tf.width)
+            pairs = torch.from_numpy(np.asarray(tf.pairs, dtype=np.int64))
+            return Samples(torch.from_numpy(rows), pairs, LENGTH), list(tf.tags)
+        x = np.zeros((len(tf), LENGTH), dtype=np.int8)
+        for start in range(0, len(tf), LOAD_CHUNK):
+            end = min(start + LOAD_CHUNK, len(tf))
+            x[start:end] = fit(tf.get(np.arange(start, end)), LENGTH)
+        return from_dense(x, LENGTH), list(tf.tags)
+
+    # legacy format, pickled dicts of uuid -> tag and uuid -> trace
+    npz = np.load(filename, allow_pickle=True)
+    t = npz["labels"].item()
+    d = npz["dataset"].item()
+    x = np.zeros((len(d), LENGTH), dtype=np.int8)
+    for i, uuid in enumerate(d):
+        n = min(LENGTH, d[uuid].shape[1])
+        x[i, :n] = d[uuid][0, :n]
+    return from_dense(x, LENGTH), [t[uuid] for uuid in d]
+
+
+def fit(x, length):
+    # int8 (n, width) traces truncated or zero padded to (n, length)
+    if x.shape[1] == length:
+        return x
+    y = np.zeros((len(x), length), dtype=np.int8)
+    n = min(length, x.shape[1])
+    y[:, :n] = x[:, :n]
+    return y
+
+
+def bf16_supported():
+    # whether the CPU has native bfloat16 (AVX512-BF16 or AMX) through oneDNN
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def enable_cpu_fast(threads=None, interop_threads=1):
+    # Compiles DF with torch.compile and trains and tests in bfloat16
+    # autocast where the CPU supports it, with explicit thread counts. Call
+    # before any other torch work, inter-op threads cannot be set after that.
+    global cpu_fast
+    cpu_fast = True
+    torch.set_num_threads(threads or os.cpu_count())
+    try:
+        torch.set_num_interop_threads(interop_threads)
+    except RuntimeError:
+        print(f"{now()} inter-op threads already set, keeping them")
+    print(
+        f"{now()} cpu-fast: torch.compile, bfloat16 autocast {bf16_supported()}, {torch.get_num_threads()} threads, {torch.get_num_interop_threads()} inter-op threads"
+    )
+
+
+def autocast(device):
+    # bfloat16 autocast in cpu-fast mode on CPUs that support it, else a no-op
+    return torch.autocast(
+        "cpu",
+        dtype=torch.bfloat16,
+        enabled=cpu_fast and device.type == "cpu" and bf16_supported(),
+    )
+
+
+def init_fold_worker(threads):
+    # torch threads of a forked fold worker, one inter-op thread as the folds
+    # themselves run in parallel
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+
+def run_folds(
+    data,
+    seed,
+    open_world=0.0,
+    workers=1,
+    fold_dir=None,
+    prefixes=None,
+    threads=None,
+    half=None,
+):
+    # runs all FOLDS folds of an experiment, see run_fold(), with up to
+    # workers folds at a time of threads torch threads each (by default cores
+    # / workers), and returns their results in fold order
+    global fold_data
+    fold_data = data
+    if workers > 1 and not torch.cuda.is_available():
+        # forked workers share the data copy-on-write, with CUDA folds run one
+        # after another since forking after CUDA init is unsafe
+        threads = threads or max(1, os.cpu_count() // workers)
+        print(f"{now()} running {workers} folds at a time, {threads} threads each")
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_fold_worker,
+            initargs=(threads,),
+        ) as executor:
+            return list(
+                executor.map(
+                    run_forked_fold,
+                    range(FOLDS),
+                    [seed] * FOLDS,
+                    [open_world] * FOLDS,
+                    [fold_dir] * FOLDS,
+                    [prefixes] * FOLDS,
+                    [half] * FOLDS,
+                )
+            )
+    return [
+        run_fold(data, k, seed, open_world, fold_dir, prefixes, half)
+        for k in range(FOLDS)
+    ]
+
+
+def run_forked_fold(k, seed, open_world, fold_dir, prefixes, half):
+    return run_fold(fold_data, k, seed, open_world, fold_dir, prefixes, half)
+
+
+def run_fold(data, k, seed, open_world=0.0, fold_dir=None, prefixes=None, half=None):
+    # Splits and runs fold k of an experiment. data is (dataset, index,
+    # labels, tags): sample i of the experiment is sample index[i] of the
+    # stacked Samples, with label labels[i] (0 or 1) and tag tags[i]. Every fold
+    # has its own seed, seed + k, so it is reproducible in any process. With
+    # a fold_dir, the fold is checkpointed to fold-k.pt in it and its test
+    # predictions are saved to fold-k.npz, see run_df(). With prefixes, the
+    # test traces are also scored truncated to each prefix length (per
+    # circuit with a half, see score_prefixes()).
+    np.random.seed(seed + k)
+    torch.manual_seed(seed + k)
+    print(f"{now()} running fold {k} with seed {seed + k}...")
+
+    dataset, index, labels, tags = data
+    train, valid, test = [
+        dataset.read_order(index[s]) for s in split(labels, tags, open_world)
+    ]
+    print(f"{now()} fold {k} train {len(train)}, valid {len(valid)}, test {len(test)}")
+
+    # labels by dataset sample
+    row_labels = torch.zeros(len(dataset), dtype=torch.long)
+    row_labels[index] = labels
+    checkpoint = None
+    if fold_dir is not None:
+        os.makedirs(fold_dir, exist_ok=True)
+        checkpoint = os.path.join(fold_dir, f"fold-{k}.pt")
+    result, predictions = run_df(
+        train, valid, test, dataset, row_labels, checkpoint, prefixes, half
+    )
+    if fold_dir is not None:
+        np.savez(os.path.join(fold_dir, f"fold-{k}.npz"), **predictions)
+    result.update(train=len(train), valid=len(valid), test=len(test))
+    return result
+
+
+def split(labels, tags, open_world=0.0):
+    # train, validation, test index tensors into labels and tags
+    train, valid, test = [], [], []
+
+    if open_world > 0.0:
+        print(f"{now()} using open world mode, stratified by tag")
+        # split by tag
+        _, tag_ids = np.unique(np.array(tags, dtype=str), return_inverse=True)
+        for tag in np.unique(tag_ids):
+            samples = np.flatnonzero(tag_ids == tag)
+
+            # with some probability, add all samples to train, else test
+            if np.random.rand() < open_world:
+                train.append(samples)
+            else:
+                test.append(samples)
+
+    else:
+        print(f"{now()} using closed world mode, stratified by label")
+        # random split, 80% train, 10% validation, 10% test, stratified by label
+        for label in np.unique(labels.numpy()):
+            samples = np.flatnonzero(labels.numpy() == label)
+            np.random.shuffle(samples)
+            train.append(samples[: int(len(samples) * 0.8)])
+            valid.append(samples[int(len(samples) * 0.8) : int(len(samples) * 0.9)])
+            test.append(samples[int(len(samples) * 0.9) :])
+
+    return [
+        torch.from_numpy(np.concatenate(s or [np.zeros(0, dtype=np.int64)]))
+        for s in (train, valid, test)
+    ]
+
+
+def batches(dataset, labels, index, shuffle=False, drop_last=False):
+    # (traces, labels) batches of the samples in index, see Samples.get()
+    if shuffle:
+        index = dataset.shuffle(index)
+    end = len(index) - len(index) % BATCH_SIZE if drop_last else len(index)
+    for start in range(0, end, BATCH_SIZE):
+        batch = index[start : start + BATCH_SIZE]
+        yield dataset.get(batch), labels[batch]
+
+
+def split_digest(*splits):
+    # identifies a split (and the dataset shape), so that a checkpoint is only
+    # used for its own split
+    h = hashlib.sha256()
+    for s in splits:
+        h.update(s.cpu().numpy().tobytes())
+        h.update(b"|")
+    return h.hexdigest()
+
+
+def save_checkpoint(path, checkpoint):
+    # write to a temporary file and rename, so a checkpoint is always complete
+    torch.save(checkpoint, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+
+def evaluate_loss(net, dataset, labels, index, criterion):
+    # mean loss over the samples in index
+    net.eval()
+    total = 0.0
+    with torch.inference_mode(), autocast(labels.device):
+        for x, Y in batches(dataset, labels, index):
+            outputs = net(x.unsqueeze(1).float()).float()
+            total += criterion(outputs, Y).item() * len(Y)
+    return total / len(index)
+
+
+def score_prefixes(net, x, prefixes, half=None):
+    # (len(prefixes), len(x)) scores of the int8 traces x truncated to every
+    # prefix length, all prefixes of a batch masked at once and scored in
+    # forward passes of BATCH_SIZE traces. With a half, traces are two
+    # circuits of half cells each and both are truncated to the prefix.
+    cells = torch.arange(x.shape[1], device=x.device)
+    if half is not None:
+        cells = torch.where(cells < half, cells, cells - half)
+    mask = cells < torch.tensor(prefixes, device=x.device)[:, None]
+    truncated = (x.unsqueeze(0) * mask.unsqueeze(1)).reshape(-1, x.shape[1])
+    scores = [
+        F.softmax(net(t.unsqueeze(1).float()).float(), dim=1)[:, 0]
+        for t in truncated.split(BATCH_SIZE)
+    ]
+    return torch.cat(scores).reshape(len(prefixes), len(x))
+
+
+def by_prefix(prefixes, half):
+    # the prefixes of result["by_prefix"], to tell if a result has them
+    return [dict(cells=p, per_circuit=half is not None) for p in prefixes or []]
+
+
+def run_df(
+    train, valid, test, dataset, labels, checkpoint=None, prefixes=None, half=None
+):
+    # Trains DF with early stopping on the validation loss (the training loss
+    # without a validation set, as in open world mode), restores the weights
+    # of the best epoch and tests them on every test sample. With a checkpoint
+    # path, the state is saved after every epoch and a killed fold resumes
+    # from it, a finished fold keeps its result there. Returns (result,
+    # predictions): result has the metrics.summary() of the fold, predictions
+    # are the test rows of the dataset with their labels and scores (the
+    # probability of label 0, the positive class) for later threshold sweeps.
+    # With prefixes (lengths in cells), the trained model also scores the test
+    # traces truncated to each prefix (per circuit with a half, see
+    # score_prefixes()), see result["by_prefix"], without training again for
+    # every length. A finished fold with other prefixes is tested again.
+    model = DF(2, length=dataset.width)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if torch.cuda.is_available():
+        model.cuda()
+
+    # int8 rows are small enough to keep on the device, batches are then
+    # built and cast to float32 there
+    dataset, labels = dataset.to(device), labels.to(device)
+    train, valid, test = train.to(device), valid.to(device), test.to(device)
+
+    # the compiled module shares its weights with model, whose state dicts are
+    # saved without the compile wrapper
+    net = torch.compile(model) if cpu_fast else model
+    optimizer = torch.optim.Adamax(params=model.parameters())
+    criterion = torch.nn.CrossEntropyLoss()
+    state = dict(epoch=0, best_loss=float("inf"), best_model=None, patience=PATIENCE)
+
+    digest = split_digest(
+        train, valid, test, torch.tensor([len(dataset), dataset.width])
+    )
+    if checkpoint is not None and os.path.exists(checkpoint):
+        saved = torch.load(checkpoint, map_location=device)
+        if saved["split"] != digest:
+            print(f"{now()} ignoring {checkpoint}, it is for another split")
+        elif "result" in saved:
+            done = [
+                dict(cells=p["cells"], per_circuit=p.get("per_circuit", False))
+                for p in saved["result"].get("by_prefix", [])
+            ]
+            if done == by_prefix(prefixes, half):
+                print(f"{now()} fold already done in {checkpoint}")
+                predictions = {
+                    k: v.cpu().numpy() for k, v in saved["predictions"].items()
+                }
+                return saved["result"], predictions
+            # other prefixes, test the saved model again
+            print(f"{now()} fold already done in {checkpoint}, testing prefixes")
+            state = dict(
+                epoch=saved["result"]["epochs"],
+                best_loss=saved["result"]["loss"],
+                best_model=saved["model"],
+                patience=0,
+            )
+        else:
+            model.load_state_dict(saved["model"])
+            optimizer.load_state_dict(saved["optimizer"])
+            torch.set_rng_state(saved["rng"].cpu())
+            if saved.get("cuda_rng") and torch.cuda.is_available():
+                torch.cuda.set_rng_state_all([r.cpu() for r in saved["cuda_rng"]])
+            state = saved["state"]
+            print(f"{now()} resuming from {checkpoint} at epoch {state['epoch']}")
+
+    while state["epoch"] < EPOCHS and state["patience"] > 0:
+        # training
+        start = time.time()
+        net.train()
+        torch.set_grad_enabled(True)
+        running_loss = 0.0
+        n = 0
+        for x, Y in batches(dataset, labels, train, shuffle=True, drop_last=True):
+            x = x.unsqueeze(1).float()
+            optimizer.zero_grad()
+            with autocast(device):
+                outputs = net(x)
+            loss = criterion(outputs.float(), Y)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.item() * len(Y)
+            n += len(Y)
+        seconds = time.time() - start
+        train_loss = running_loss / max(n, 1)
+
+        if len(valid) > 0:
+            loss = evaluate_loss(net, dataset, labels, valid, criterion)
+            losses = f"train loss {train_loss:.4f}, valid loss {loss:.4f}"
+        else:
+            loss = train_loss
+            losses = f"train loss {train_loss:.4f}"
+        print(
+            f"{now()} epoch {state['epoch']}, {losses}, {seconds:.1f}s, {n / seconds:.0f} samples/s"
+        )
+
+        if loss < state["best_loss"]:
+            state["best_loss"] = loss
+            state["best_model"] = copy.deepcopy(model.state_dict())
+            state["patience"] = PATIENCE
+        else:
+            state["patience"] -= 1
+            if state["patience"] == 0:
+                print(f"\tearly stopping, patience {PATIENCE} reached")
+        state["epoch"] += 1
+
+        if checkpoint is not None:
+            save_checkpoint(
+                checkpoint,
+                dict(
+                    split=digest,
+                    model=model.state_dict(),
+                    optimizer=optimizer.state_dict(),
+                    rng=torch.get_rng_state(),
+                    cuda_rng=(
+                        torch.cuda.get_rng_state_all()
+                        if torch.cuda.is_available()
+                        else []
+                    ),
+                    state=state,
+                ),
+            )
+
+    # test the best epoch
+    if state["best_model"] is not None:
+        model.load_state_dict(state["best_model"])
+    print(f"{now()} testing the best epoch, loss {state['best_loss']:.4f}")
+
+    # testing, every sample
+    net.eval()
+    scores, prefix_scores = [], []
+    with torch.inference_mode(), autocast(device):
+        for x, _ in batches(dataset, labels, test):
+            outputs = net(x.unsqueeze(1).float()).float()
+            scores.append(F.softmax(outputs, dim=1)[:, 0])
+            if prefixes:
+                prefix_scores.append(score_prefixes(net, x, prefixes, half))
+    predictions = dict(
+        rows=test.cpu().numpy(),
+        labels=labels[test].cpu().numpy().astype(np.int8),
+        scores=torch.cat(scores).cpu().numpy() if scores else np.zeros(0, np.float32),
+    )
+
+    result = metrics.summary(predictions["scores"], predictions["labels"] == 0)
+    result.update(epochs=state["epoch"], loss=state["best_loss"])
+    if prefixes:
+        predictions["prefixes"] = np.array(prefixes, dtype=np.int32)
+        predictions["prefix_scores"] = (
+            torch.cat(prefix_scores, dim=1).cpu().numpy()
+            if prefix_scores
+            else np.zeros((len(prefixes), 0), np.float32)
+        )
+        result["by_prefix"] = [
+            dict(p, **metrics.summary(s, predictions["labels"] == 0))
+            for p, s in zip(by_prefix(prefixes, half), predictions["prefix_scores"])
+        ]
+    print(
+        f"{now()} fold fpr {result['fpr']:.4f}, tpr {result['tpr']:.4f}, fnr {result['fnr']:.4f}, tnr {result['tnr']:.4f}, roc auc {result['roc_auc']:.4f}"
+    )
+
+    if checkpoint is not None:
+        save_checkpoint(
+            checkpoint,
+            dict(
+                split=digest,
+                model=state["best_model"],
+                result=result,
+                predictions={k: torch.from_numpy(v) for k, v in predictions.items()},
+            ),
+        )
+    return result, predictions
+
+
+def save_model(path, model, length, classes, **info):
+    # A trained DF for score-traces.py: its state dict, the input length in
+    # cells and the class names by label, plus any info (fold, seed, result).
+    torch.save(dict(model=model, length=length, classes=list(classes), **info), path)
+
+
+def load_model(path, device):
+    # (model in eval mode on device, saved dict) of a save_model() file
+    saved = torch.load(path, map_location=device)
+    model = DF(len(saved["classes"]), length=saved["length"])
+    model.load_state_dict(saved["model"])
+    return model.to(device).eval(), saved
+
+
+# from https://github.com/Xinhao-Deng/Website-Fingerprinting-Library/blob/master/WFlib/models/DF.py
+class ConvBlock(nn.Module):
+    def __init__(
+        self,
+        in_channels,
+        out_channels,
+        kernel_size,
+        stride,
+        pool_size,
+        pool_stride,
+        dropout_p,
+        activation,
+    ):
+        super(ConvBlock, self).__init__()
+        padding = (
+            kernel_size // 2
+        )  # Calculate padding to keep the output size same as input size
+        # Define a convolutional block consisting of two convolutional layers,
+        # each followed by batch normalization and activation
+        self.block = nn.Sequential(
+            nn.Conv1d(
+                in_channels,
+                out_channels,
+                kernel_size,
+                stride,
+                padding=padding,
+                bias=False,
+            ),  # First convolutional layer
+            nn.BatchNorm1d(out_channels),  # Batch normalization layer
+            activation(inplace=True),  # Activation function (e.g., ELU or ReLU)
+            nn.Conv1d(
+                out_channels,
+                out_channels,
+                kernel_size,
+                stride,
+                padding=padding,
+                bias=False,
+            ),  # Second convolutional layer
+            nn.BatchNorm1d(out_channels),  # Batch normalization layer
+            activation(inplace=True),  # Activation function
+            nn.MaxPool1d(
+                pool_size, pool_stride, padding=0
+            ),  # Max pooling layer to downsample the input
+            nn.Dropout(p=dropout_p),  # Dropout layer for regularization
+        )
+
+    def forward(self, x):
+        # Pass the input through the convolutional block
+        return self.block(x)
+
+
+# from https://github.com/Xinhao-Deng/Website-Fingerprinting-Library/blob/master/WFlib/models/DF.py
+class DF(nn.Module):
+    def __init__(self, num_classes, num_tab=1, length=5000):
+        super(DF, self).__init__()
+
+        # Configuration parameters for the convolutional blocks
+        filter_num = [32, 64, 128, 256]  # Number of filters for each block
+        kernel_size = 8  # Kernel size for convolutional layers
+        conv_stride_size = 1  # Stride size for convolutional layers
+        pool_stride_size = 4  # Stride size for max pooling layers
+        pool_size = 8  # Kernel size for max pooling layers
+
+        # Length of the feature map after the feature extraction part (18 for
+        # 5000 cells): in each block, two padded convolutions and a max pool
+        length_after_extraction = length
+        for _ in filter_num:
+            for _ in range(2):
+                length_after_extraction = (
+                    length_after_extraction + 2 * (kernel_size // 2) - kernel_size
+                ) // conv_stride_size + 1
+            length_after_extraction = (
+                length_after_extraction - pool_size
+            ) // pool_stride_size + 1
+        if length_after_extraction < 1:
+            raise ValueError(f"DF needs longer traces than {length} cells")
+
+        # Define the feature extraction part of the network using a sequential
+        # container with ConvBlock instances
+        self.feature_extraction = nn.Sequential(
+            ConvBlock(
+                1,
+                filter_num[0],
+                kernel_size,
+                conv_stride_size,
+                pool_size,
+                pool_stride_size,
+                0.1,
+                nn.ELU,
+            ),  # Block 1
+            ConvBlock(
+                filter_num[0],
+                filter_num[1],
+                kernel_size,
+                conv_stride_size,
+                pool_size,
+                pool_stride_size,
+                0.1,
+                nn.ReLU,
+            ),  # Block 2
+            ConvBlock(
+                filter_num[1],
+                filter_num[2],
+                kernel_size,
+                conv_stride_size,
+                pool_size,
+                pool_stride_size,
+                0.1,
+                nn.ReLU,
+            ),  # Block 3
+            ConvBlock(
+                filter_num[2],
+                filter_num[3],
+                kernel_size,
+                conv_stride_size,
+                pool_size,
+                pool_stride_size,
+                0.1,
+                nn.ReLU,
+            ),  # Block 4
+        )
+
+        # Define the classifier part of the network
+        self.classifier = nn.Sequential(
+            nn.Flatten(),  # Flatten the tensor to a vector
+            nn.Linear(
+                filter_num[3] * length_after_extraction, 512, bias=False
+            ),  # Fully connected layer
+            nn.BatchNorm1d(512),  # Batch normalization layer
+            nn.ReLU(inplace=True),  # ReLU activation function
+            nn.Dropout(p=0.7),  # Dropout layer for regularization
+            nn.Linear(512, 512, bias=False),  # Fully connected layer
+            nn.BatchNorm1d(512),  # Batch normalization layer
+            nn.ReLU(inplace=True),  # ReLU activation function
+            nn.Dropout(p=0.5),  # Dropout layer for regularization
+            nn.Linear(512, num_classes),  # Output layer
+        )
+
+    def forward(self, x):
+        # Pass the input through the feature extraction part
+        x = self.feature_extraction(x)
+
+        # Pass the output through the classifier part
+        x = self.classifier(x)
+
+        return x
+
+
+def now():
+    return datetime.now().strftime("%H:%M:%S")
@@ -1,146 +1,218 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import numpy as np
-import pickle
-from collections import Counter
-
-
-def cells2df(cells, length=512):
-    data = np.zeros((1, length), dtype=np.float32)
-    cell_directions = cells["direction"].astype(np.float32)
-    data[0, : len(cell_directions)] = cell_directions[:length]
-    return data
-
-
-def is_dir_circuit(cells):
-    for cell in cells:
-        if cell["relay_cmd"] == 13:
-            return True
-    return False
-
-
-def get_max_nonzero_trace(traces):
-    max_trace = None
-    max_trace_len = -1
-    for t in traces:
-        if get_trace_length(t) > max_trace_len:
-            max_trace = t
-            max_trace_len = get_trace_length(t)
-    return max_trace
-
-
-def get_trace_length(trace):
-    return len(np.nonzero(trace)[0])
-
-
-KIND_GENERAL = 0
-KIND_HSDIR = 1
-KIND_INTRO = 2
-KIND_REND = 3
-
-FILTERED_DOMAINS = [
-    b"securedrop.org",
-    b"185.220.103.112",
-    b"185.220.103.119",
+import circuitindex
+from concurrent.futures import ProcessPoolExecutor
+from resultcache import MAX_BYTES, DIRECTORY, ResultCache
+from traces import (
+    KIND_GENERAL,
+    KIND_REND,
+    FILTERED_DOMAINS,
+    group_by,
+)
+
+# trace length used for the sizes below
+LENGTH = 512
+
+# part of the cache keys, bump it when the cached per-tag results change
+CACHE_VERSION = 1
+
+# Stats are accumulated per tag file in worker processes and merged in tag
+# order. Counters are added, sizes (at most LENGTH) are histograms with one
+# bin per size, rend circuits per fetch are a histogram of counts and domains
+# (ids into the domains of the circuitindex) are counted by the fetches they
+# occur in, so the merged stats do not grow with the number of fetches.
+# The stats of a tag file are computed with the domain ids of the tag file
+# (into its sorted domains), so they are cached independently of the other
+# tag files, and mapped to the ids of the dataset before merging.
+COUNTERS = [
+    "total_fetches",
+    "total_circuits",
+    "dir",
+    "no-general",
+    "no-rend",
+    "inconsistent-size-below-100",
+    "largest-is-rend",
+    "largest-is-general",
+    "filtered-circuits",
+    "largest-rend-is-cflare",
 ]
+HISTOGRAMS = ["largest-general", "largest-rend", "smallest-ol-circ"]
+
+
+def empty_stats():
+    stats = {name: 0 for name in COUNTERS}
+    stats.update({name: np.zeros(LENGTH + 1, dtype=np.int64) for name in HISTOGRAMS})
+    stats["rend-per-fetch"] = np.zeros(0, dtype=np.int64)
+    return stats
+
+
+def tag_stats(job):
+    # Stats of the circuits of one tag file, from their circuitindex features
+    # and the ids of FILTERED_DOMAINS and the cloudflare domains (all ids of
+    # the domains of the tag file, see dataset_stats()). Domains are
+    # (ids in order of first use, fetches with each), and fetch-domains has
+    # the domains of every fetch in order, both only until merged.
+    c, filtered_ids, cflare_ids = job
+    stats = empty_stats()
+    rend_per_fetch, fetch_domains = [], []
+    lengths = np.minimum(c["cells"], LENGTH)
+
+    for _, kind, domain, fetch_dir, fetch_lengths in group_by(
+        c["fetch"], c["kind"], c["domain"], c["dir"], lengths
+    ):
+        stats["total_fetches"] += 1
+        stats["total_circuits"] += len(kind)
+
+        # domains in order of first use, only the first circuit of each
+        # domain is checked for being a directory circuit
+        first = np.sort(np.unique(domain, return_index=True)[1])
+        domains = domain[first]
+        is_dir = np.zeros(len(kind), dtype=bool)
+        is_dir[first] = (kind[first] == KIND_GENERAL) & fetch_dir[first]
+        stats["dir"] += np.count_nonzero(is_dir)
+
+        filtered = ~is_dir & np.isin(domain, filtered_ids)
+        stats["filtered-circuits"] += np.count_nonzero(filtered)
+
+        keep = ~(is_dir | filtered)
+        kept_lengths = fetch_lengths[keep]
+        kept_domain = domain[keep]
+
+        # kind -> trace lengths
+        traces = dict(group_by(kind[keep], kept_lengths))
+
+        fetch_domains.append(domains)
+        rend_per_fetch.append(len(traces[KIND_REND]) if KIND_REND in traces else 0)
+
+        if KIND_GENERAL not in traces:
+            stats["no-general"] += 1
+        if KIND_REND not in traces:
+            stats["no-rend"] += 1
+        if KIND_GENERAL not in traces or KIND_REND not in traces:
+            # only want fetches that might have done something
+            continue
+        largest_general_len = traces[KIND_GENERAL].max()
+        largest_rend_len = traces[KIND_REND].max()
+
+        # domain of the last circuit with the size of the largest rend
+        size_domain = kept_domain[np.flatnonzero(kept_lengths == largest_rend_len)[-1]]
+        if size_domain in cflare_ids:
+            stats["largest-rend-is-cflare"] += 1
+
+        stats["largest-general"][largest_general_len] += 1
+        stats["largest-rend"][largest_rend_len] += 1
+        stats["smallest-ol-circ"][min(largest_general_len, largest_rend_len)] += 1
+
+        if (
+            largest_general_len < 100 and largest_rend_len < 100
+        ) and largest_rend_len > largest_general_len:
+            stats["inconsistent-size-below-100"] += 1
+
+        if largest_rend_len > largest_general_len:
+            stats["largest-is-rend"] += 1
+        else:
+            stats["largest-is-general"] += 1
+
+    stats["rend-per-fetch"] = np.bincount(rend_per_fetch, minlength=1)
+    stats["fetch-domains"] = fetch_domains
+    all_domains = np.concatenate(fetch_domains or [np.zeros(0, dtype=np.int32)])
+    ids, first, counts = np.unique(all_domains, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    stats["domains"] = (ids[order], counts[order])
+    return stats
+
+
+def dataset_ids(stats, ids):
+    # stats with the domain ids of a tag file mapped to the ids of the dataset
+    domains, counts = stats["domains"]
+    stats = dict(stats, domains=(ids[domains], counts))
+    stats["fetch-domains"] = [ids[f] for f in stats["fetch-domains"]]
+    return stats
+
+
+def merge(total, stats):
+    # adds the stats of the next tag file to total
+    for name in COUNTERS:
+        total[name] += stats[name]
+    for name in HISTOGRAMS:
+        total[name] += stats[name]
+    a, b = total["rend-per-fetch"], stats["rend-per-fetch"]
+    if len(b) > len(a):
+        a, b = b.copy(), a
+    a[: len(b)] += b
+    total["rend-per-fetch"] = a
+
+    # fetches per domain, and the order in which domains were first used
+    ids, counts = stats["domains"]
+    total["domain-fetches"][ids] += counts
+    new = ids[total["first-use"][ids] < 0]
+    total["first-use"][new] = total["used"] + np.arange(len(new))
+    total["used"] += len(new)
+
+    # common domains in all fetches so far, in fetch order (starting over when
+    # there are none)
+    for fetch in stats["fetch-domains"]:
+        if len(total["common-domains"]) == 0:
+            total["common-domains"] = fetch
+        else:
+            common = total["common-domains"]
+            total["common-domains"] = common[np.isin(common, fetch)]
+
+
+def dataset_stats(executor, cache, dataset):
+    # the circuits of all tag files (.circuits or .pickle), sorted, see
+    # index-circuits.py
+    index = circuitindex.load(dataset, executor)
+    domains = index["domains"]
+    filtered_ids = circuitindex.domain_ids(index, FILTERED_DOMAINS)
+    cflare_ids = np.flatnonzero(np.char.find(domains, b"cflare") >= 0)
+    jobs, keys, tag_ids = [], [], []
+    for i in range(len(index["files"])):
+        c = circuitindex.features(index, i)
+        # the dataset id of every domain id of the tag file
+        ids, c["domain"] = np.unique(c["domain"], return_inverse=True)
+        jobs.append(
+            (
+                c,
+                np.flatnonzero(np.isin(ids, filtered_ids)),
+                np.flatnonzero(np.isin(ids, cflare_ids)),
+            )
+        )
+        keys.append(
+            cache.key(
+                index["digests"][i],
+                script="dataset-stats",
+                version=CACHE_VERSION,
+                LENGTH=LENGTH,
+                FILTERED_DOMAINS=FILTERED_DOMAINS,
+                cflare=b"cflare",
+            )
+        )
+        tag_ids.append(ids)
+    results = cache.map(
+        tag_stats,
+        jobs,
+        keys,
+        lambda f, jobs: executor.map(f, jobs, chunksize=16),
+    )
+    stats = empty_stats()
+    stats.update(
+        {
+            "domain-fetches": np.zeros(len(domains), dtype=np.int64),
+            "first-use": np.full(len(domains), -1, dtype=np.int64),
+            "used": 0,
+            "common-domains": np.zeros(0, dtype=np.int32),
+        }
+    )
+    for s, ids in zip(results, tag_ids):
+        merge(stats, dataset_ids(s, ids))
+    stats["domains"] = domains
+    return index["files"], stats
 
-for dataset in ["clearnet", "onion", "autoloc", "curl"]:
-    print(f"Dataset {dataset}")
-    # in the directory, list all files and filter those that end with ".pickle"
-    # then, sort the list of files
-    files = sorted([f for f in os.listdir(dataset) if f.endswith(".pickle")])
-    print(f"Processing {len(files)} files...")
-
-    stats = {}
-    stats["total_fetches"] = 0
-    stats["total_circuits"] = 0
-    stats["dir"] = 0
-    stats["no-general"] = 0
-    stats["no-rend"] = 0
-    stats["largest-general"] = []
-    stats["largest-rend"] = []
-    stats["smallest-ol-circ"] = []
-    stats["inconsistent-size-below-100"] = 0
-    stats["largest-is-rend"] = 0
-    stats["largest-is-general"] = 0
-    stats["filtered-circuits"] = 0
-    stats["rend-per-fetch"] = []
-    stats["largest-rend-is-cflare"] = 0
-
-    domains_per_fetch = {}
-
-    for i, f in enumerate(files):
-        with open(os.path.join(dataset, f), "rb") as file:
-            (tag, selected_circuits) = pickle.load(file)
-
-            fetches = np.unique(selected_circuits["fetch"])
-            stats["total_fetches"] += len(fetches)
-            for f in fetches:
-                uuid = f"{dataset}-{tag}-{f}"
-                circuits = selected_circuits[selected_circuits["fetch"] == f]
-                stats["total_circuits"] += len(circuits)
-                domains = []
-
-                # kind -> list of traces
-                traces = {}
-                size2domain = {}
-                for c in circuits:
-                    if c["domain"] not in domains:
-                        domains.append(c["domain"])
-
-                        if c["kind"] == KIND_GENERAL:
-                            if is_dir_circuit(c["cells"]):
-                                stats["dir"] += 1
-                                continue
-
-                    if c["domain"] in FILTERED_DOMAINS:
-                        stats["filtered-circuits"] += 1
-                        continue
-
-                    t = cells2df(
-                        c["cells"][np.vectorize(lambda cell: cell[3] != 16)(c["cells"])]
-                    )
-                    if c["kind"] not in traces:
-                        traces[c["kind"]] = []
-                    traces[c["kind"]].append(t)
-                    size2domain[get_trace_length(t)] = c["domain"]
-
-                domains_per_fetch[uuid] = domains
-                stats["rend-per-fetch"].append(
-                    len(traces[KIND_REND]) if KIND_REND in traces else 0
-                )
-
-                if KIND_GENERAL not in traces:
-                    stats["no-general"] += 1
-                if KIND_REND not in traces:
-                    stats["no-rend"] += 1
-                if KIND_GENERAL not in traces or KIND_REND not in traces:
-                    # only want fetches that might have done something
-                    continue
-                largest_general = get_max_nonzero_trace(traces[KIND_GENERAL])
-                largest_general_len = get_trace_length(largest_general)
-                largest_rend = get_max_nonzero_trace(traces[KIND_REND])
-                largest_rend_len = get_trace_length(largest_rend)
-
-                if b"cflare" in size2domain[largest_rend_len]:
-                    stats["largest-rend-is-cflare"] += 1
-
-                stats["largest-general"].append(largest_general_len)
-                stats["largest-rend"].append(largest_rend_len)
-                stats["smallest-ol-circ"].append(
-                    min(largest_general_len, largest_rend_len)
-                )
-
-                if (
-                    largest_general_len < 100 and largest_rend_len < 100
-                ) and largest_rend_len > largest_general_len:
-                    stats["inconsistent-size-below-100"] += 1
-
-                if largest_rend_len > largest_general_len:
-                    stats["largest-is-rend"] += 1
-                else:
-                    stats["largest-is-general"] += 1
 
+def print_stats(dataset, files, stats):
     fetches = stats["total_fetches"]
     circuits = stats["total_circuits"]
     print("")
@@ -160,12 +232,13 @@ for dataset in ["clearnet", "onion", "autoloc", "curl"]:
         f"{stats['largest-is-general']} fetches had general circuits larger than rend circuits"
     )
 
-    # average, min, max of rend circuits per fetch
+    # average, min, max of rend circuits per fetch, from their histogram
     rend_per_fetch = stats["rend-per-fetch"]
-    rend_per_fetch.sort()
-    median = rend_per_fetch[len(rend_per_fetch) // 2]
+    counts = np.flatnonzero(rend_per_fetch)
+    median = np.searchsorted(np.cumsum(rend_per_fetch), fetches // 2, side="right")
+    total = np.dot(np.arange(len(rend_per_fetch)), rend_per_fetch)
     print(
-        f"Average number of rend circuits per fetch: {sum(rend_per_fetch) / fetches:.2f} (median: {median}, min: {min(rend_per_fetch)}, max: {max(rend_per_fetch)})"
+        f"Average number of rend circuits per fetch: {total / fetches:.2f} (median: {median}, min: {counts[0]}, max: {counts[-1]})"
     )
     # largest cflare
     print(
@@ -176,25 +249,24 @@ for dataset in ["clearnet", "onion", "autoloc", "curl"]:
         f"{stats['filtered-circuits']} circuits were filtered out due to domain in {FILTERED_DOMAINS}"
     )
 
-    # go over each list of domains per fetch and make a list of common domains in all fetches
-    common_domains = []
-    for fetch in domains_per_fetch.values():
-        if len(common_domains) == 0:
-            common_domains = fetch
-        else:
-            common_domains = list(set(common_domains) & set(fetch))
+    # list of common domains in all fetches, see merge()
+    domains = stats["domains"]
+    common_domains = [bytes(domains[i]) for i in stats["common-domains"]]
     print(f"Common domains in all fetches: {common_domains}")
 
-    # find the top-20 most common domains in all fetches (20 to capture cloudflare)
-    all_domains = [domain for fetch in domains_per_fetch.values() for domain in fetch]
-    domain_counter = Counter(all_domains)
+    # find the top-20 most common domains in all fetches (20 to capture
+    # cloudflare), ties in order of first use
+    count = stats["domain-fetches"]
+    used = np.flatnonzero(count)
+    top = used[np.lexsort((stats["first-use"][used], -count[used]))][:20]
     print("Top-20 most common domains:")
-    for domain, count in domain_counter.most_common(20):
-        print(f"{domain}: {count}")
+    for i in top:
+        print(f"{bytes(domains[i])}: {count[i]}")
 
-    # sort largest stats
-    stats["largest-general"] = sorted(stats["largest-general"])
-    stats["largest-rend"] = sorted(stats["largest-rend"])
+    # fetches with at least X non-zero cells, from the cumulative histograms
+    at_least = {
+        name: np.append(np.cumsum(stats[name][::-1])[::-1], 0) for name in HISTOGRAMS
+    }
 
     sizes = [
         10,
@@ -218,11 +290,49 @@ for dataset in ["clearnet", "onion", "autoloc", "curl"]:
     ]
     # percentage of general and rend circuits that have at least X non-zero cells
     for s in sizes:
-        general = len([x for x in stats["largest-general"] if x >= s])
-        rend = len([x for x in stats["largest-rend"] if x >= s])
-        ol = len([x for x in stats["smallest-ol-circ"] if x >= s])
+        general = at_least["largest-general"][min(s, LENGTH + 1)]
+        rend = at_least["largest-rend"][min(s, LENGTH + 1)]
+        ol = at_least["smallest-ol-circ"][min(s, LENGTH + 1)]
         # print(f'{general} general circuits and {rend} rend circuits have at least {s} non-zero cells')
         print(
             f"{ol} fetches ({100 * ol / fetches:.1f}%) have at least {s} non-zero cells on both circuits ({general} general and {rend} rend)"
         )
     print("")
+
+
+def main():
+    cache = ResultCache(None if args.no_cache else args.cache, args.cache_size << 20)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for dataset in ["clearnet", "onion", "autoloc", "curl"]:
+            print(f"Dataset {dataset}")
+            files, stats = dataset_stats(executor, cache, dataset)
+            print(f"Processing {len(files)} files...")
+            print_stats(dataset, files, stats)
+    cache.trim()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print statistics of the datasets")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes",
+    )
+    parser.add_argument(
+        "--cache",
+        default=DIRECTORY,
+        help="directory of the per-tag-file cache of stats",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=MAX_BYTES >> 20,
+        help="size cap of the cache in MiB, least recently used stats are removed",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="compute all stats, store nothing"
+    )
+    args = parser.parse_args()
+    main()
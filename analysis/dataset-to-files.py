@@ -1,35 +1,271 @@
 #!/usr/bin/env python3
+import argparse
+import glob
 import h5py
+import multiprocessing
 import numpy as np
 import pickle
 import os
+import queue
+import shutil
+import circuitstore
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
 
-with h5py.File("onionloc.hdf5", "r") as f:
-    for dataset in ["clearnet", "onion", "autoloc", "curl"]:
-        print(f"\nProcessing dataset: {dataset}")
+DATASETS = ["clearnet", "onion", "autoloc", "curl"]
 
-        if os.path.exists(dataset):
-            print(f"Directory '{dataset}' exists, skipping this dataset...")
-            continue
-        os.mkdir(dataset)
+# number of rows read from the hdf5 file at a time, bounds memory usage
+CHUNK_SIZE = 50000
 
+
+def build_index(raw):
+    # read only the tag column, once, and map each row to its tag number
+    tags, inverse = np.unique(raw.fields("tag")[:], return_inverse=True)
+    first_row = np.unique(inverse, return_index=True)[1]
+    # the last row of each tag, after which the tag is complete
+    rev_first = np.unique(inverse[::-1], return_index=True)[1]
+    last_row = len(inverse) - 1 - rev_first
+    return tags, inverse, first_row, last_row
+
+
+def partition(raw, ids, first_row, last_row, offset, chunk_size=CHUNK_SIZE):
+    # stream contiguous chunks of rows starting at offset, yielding (tag
+    # number, circuits, complete) for every tag with rows in the chunk, where
+    # complete means that all rows of the tag are in ids and have been read.
+    # Rows with id -1 are skipped (tags that are done).
+    for start in range(0, len(ids), chunk_size):
+        end = min(start + chunk_size, len(ids))
+        rows = raw[offset + start : offset + end]
+        chunk_ids = ids[start:end]
+        order = np.argsort(chunk_ids, kind="stable")
+        order = order[chunk_ids[order] >= 0]
+        present, first, counts = np.unique(
+            chunk_ids[order], return_index=True, return_counts=True
+        )
+        for t, i, n in zip(present, first, counts):
+            complete = first_row[t] >= offset and last_row[t] < offset + end
+            yield t, rows[order[i : i + n]], complete
+
+
+def tag_path(dataset, i, suffix):
+    return os.path.join(dataset, f"{i}{suffix}")
+
+
+def spill_path(dataset, i, job):
+    # rows of tag i read by job that are not yet written
+    return os.path.join(dataset, f"{i}.{job}.part")
+
+
+def load_spilled(p):
+    parts = []
+    with open(p, "rb") as f:
+        while True:
+            try:
+                parts.append(pickle.load(f))
+            except EOFError:
+                break
+    return parts
+
+
+def write_tag(p, tag, circuits):
+    # write to a temporary file and rename, so that an existing tag file is
+    # always complete and marks the tag as done for later runs
+    if p.endswith(circuitstore.SUFFIX):
+        circuitstore.save_tag(p, circuits)
+        return
+    with open(f"{p}.tmp", "wb") as f:
+        pickle.dump((tag, circuits), f)
+    os.replace(f"{p}.tmp", p)
+
+
+def write_rows(dataset, i, tag, parts, spilled, suffix):
+    # writes tag i from its rows, in file order, and removes its spill files
+    circuits = np.concatenate(parts)
+    selected_circuits = circuits[np.argsort(circuits["time_created"], kind="stable")]
+    write_tag(tag_path(dataset, i, suffix), tag, selected_circuits)
+    for p in spilled:
+        os.remove(p)
+
+
+def make_jobs(input, dataset, groups, chunk_size, suffix):
+    # (jobs, merges, number of tags) for the tags of dataset that are not
+    # done, see extract() and merge()
+    with h5py.File(input, "r") as f:
         raw = f[dataset]
         print(f"Dataset shape for '{dataset}': {raw.shape}")
+        tags, inverse, first_row, last_row = build_index(raw)
+
+    missing = [
+        i for i in range(len(tags)) if not os.path.exists(tag_path(dataset, i, suffix))
+    ]
+    print(f"Processing {len(missing)} of {len(tags)} tags for dataset '{dataset}'...")
+    for i in missing:
+        paths = glob.glob(os.path.join(dataset, f"{i}.*.part"))
+        for p in paths + [f"{tag_path(dataset, i, suffix)}.tmp"]:
+            if os.path.isdir(p):
+                shutil.rmtree(p)
+            elif os.path.exists(p):
+                os.remove(p)
+
+    # The rows spanning the missing tags are split into one contiguous range
+    # per job, so every row is read once. A job writes the tags that lie
+    # entirely in its range and spills the rows of the others per tag, which
+    # are merged once all jobs are done.
+    if len(missing) == 0:
+        return [], [], 0
+    missing = np.array(missing, dtype=np.int64)
+    start = first_row[missing].min()
+    end = last_row[missing].max() + 1
+    bounds = np.linspace(start, end, min(groups, end - start) + 1).astype(np.int64)
+    jobs = []
+    for number, (a, b) in enumerate(zip(bounds[:-1], bounds[1:])):
+        ids = inverse[a:b].copy()
+        ids[~np.isin(ids, missing)] = -1
+        jobs.append(
+            (
+                input,
+                dataset,
+                tags,
+                ids,
+                first_row,
+                last_row,
+                int(a),
+                chunk_size,
+                suffix,
+                number,
+            )
+        )
+    # the tags whose first and last rows are in different ranges
+    job_of = lambda rows: np.searchsorted(bounds, rows, side="right") - 1
+    crossing = missing[job_of(first_row[missing]) != job_of(last_row[missing])]
+    merges = [(dataset, int(i), tags[i], len(jobs), suffix) for i in crossing]
+    return jobs, merges, len(missing)
+
+
+def extract(job, progress):
+    (
+        input,
+        dataset,
+        tags,
+        ids,
+        first_row,
+        last_row,
+        offset,
+        chunk_size,
+        suffix,
+        number,
+    ) = job
+    with h5py.File(input, "r") as f:
+        raw = f[dataset]
+        for i, part, complete in partition(
+            raw, ids, first_row, last_row, offset, chunk_size
+        ):
+            p = spill_path(dataset, i, number)
+            if not complete:
+                with open(p, "ab") as s:
+                    pickle.dump(part, s)
+                continue
+            spilled = [p] if os.path.exists(p) else []
+            parts = (load_spilled(p) if spilled else []) + [part]
+            write_rows(dataset, i, tags[i], parts, spilled, suffix)
+            progress(1)
+
+
+def merge(job, progress):
+    # writes a tag from the rows spilled by every job, in job (file) order
+    dataset, i, tag, jobs, suffix = job
+    spilled = [spill_path(dataset, i, j) for j in range(jobs)]
+    spilled = [p for p in spilled if os.path.exists(p)]
+    parts = [part for p in spilled for part in load_spilled(p)]
+    write_rows(dataset, i, tag, parts, spilled, suffix)
+    progress(1)
+
+
+def init_worker(q):
+    global progress_queue
+    progress_queue = q
+
+
+def worker(function, job):
+    function(job, progress_queue.put)
+
+
+def main():
+    # with fewer workers than datasets, a worker owns a whole dataset
+    groups = max(1, args.workers // len(args.datasets))
+    jobs, merges, total = [], [], 0
+    for dataset in args.datasets:
+        print(f"\nIndexing dataset: {dataset}")
+        os.makedirs(dataset, exist_ok=True)
+        j, m, n = make_jobs(
+            args.input, dataset, groups, args.chunk_size, f".{args.format}"
+        )
+        jobs.extend(j)
+        merges.extend(m)
+        total += n
+
+    print(f"\nExtracting {total} tags using {args.workers} worker(s)...")
+    with tqdm(total=total, unit="tag") as pbar:
+        run(extract, jobs, pbar)
+        # tags spanning several jobs, once all their rows are spilled
+        run(merge, merges, pbar)
 
-        tags = list(np.unique(raw["tag"]))
-        print(f"Processing {len(tags)} tags for dataset '{dataset}'...")
+    print("Done")
 
-        for i, tag in enumerate(tags):
-            selected_circuits = raw[raw["tag"] == tag]
-            selected_circuits = selected_circuits[
-                np.argsort(selected_circuits["time_created"])
-            ]
 
-            fname = f"{i}.pickle"
-            p = os.path.join(dataset, fname)
-            print(f"Saving {len(selected_circuits)} circuits to {p}...")
-            pickle.dump((tag, selected_circuits), open(p, "wb"))
+def run(function, jobs, pbar):
+    # function over jobs, in worker processes if there are several
+    if args.workers == 1:
+        for job in jobs:
+            function(job, pbar.update)
+        return
+    ctx = multiprocessing.get_context("spawn")
+    q = ctx.Queue()
+    with ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=ctx,
+        initializer=init_worker,
+        initargs=(q,),
+    ) as executor:
+        futures = [executor.submit(worker, function, job) for job in jobs]
+        while not all(f.done() for f in futures):
+            try:
+                pbar.update(q.get(timeout=1))
+            except queue.Empty:
+                pass
+        # raises the first error of a failed job, if any
+        for f in futures:
+            f.result()
+        while not q.empty():
+            pbar.update(q.get())
 
-            print(f"Tag {i + 1}/{len(tags)} done for dataset '{dataset}'")
 
-        print(f"Finished processing dataset: {dataset}")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract one file per tag from the hdf5 datasets, resumable"
+    )
+    parser.add_argument(
+        "-i", "--input", default="onionloc.hdf5", help="hdf5 file to extract from"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "-c",
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="number of rows read at a time",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["circuits", "pickle"],
+        default="circuits",
+        help="write columnar .circuits directories or (tag, circuits) pickles",
+    )
+    parser.add_argument(
+        "datasets", nargs="*", default=DATASETS, help="datasets to extract"
+    )
+    args = parser.parse_args()
+    main()
@@ -1,130 +1,178 @@
 #!/usr/bin/env python3
+import argparse
 import numpy as np
 import os
-import pickle
-
-KIND_GENERAL = 0
-KIND_HSDIR = 1
-KIND_INTRO = 2
-KIND_REND = 3
-
-
-def cells2df(cells, length=512):
-    data = np.zeros((1, length), dtype=np.float32)
-    cell_directions = cells["direction"].astype(np.float32)
-    data[0, : len(cell_directions)] = cell_directions[:length]
-    return data
+import circuitindex
+import tracefile
+from circuitstore import load_tag
+from resultcache import DIRECTORY, MAX_BYTES, ResultCache
+from traces import (
+    KIND_GENERAL,
+    KIND_HSDIR,
+    KIND_INTRO,
+    KIND_REND,
+    featurize,
+    group_by,
+)
 
+# circuit fingerprinting trace length
+LENGTH = 512
 
-def is_dir_circuit(cells):
-    for cell in cells:
-        if cell["relay_cmd"] == 13:
-            return True
-    return False
+# part of the cache keys, bump it when the cached per-tag results change
+CACHE_VERSION = 1
 
 
-def process_kinds(kinds, uuid, tag, traces, labels, dataset):
+def process_kinds(kinds, uuid, tag, traces, rows, tags, ids):
     for kind in kinds:
         if kind in traces:
-            for i, t in enumerate(traces[kind]):
-                ID = f"{uuid}-{kind}-{i}"
-                labels[ID] = tag
-                dataset[ID] = t
-
-
-def extract_dataset(kinds, files, name):
-    labels, dataset = {}, {}
-    for i, f in enumerate(files):
-        with open(os.path.join(name, f), "rb") as file:
-            (tag, selected_circuits) = pickle.load(file)
-
-            fetches = np.unique(selected_circuits["fetch"])
-            for f in fetches:
-                uuid = f"{name}-{tag}-{f}"
-                circuits = selected_circuits[selected_circuits["fetch"] == f]
-
-                # kind -> list of traces
-                traces = {}
-                for c in circuits:
-                    if c["kind"] == KIND_GENERAL:
-                        if is_dir_circuit(c["cells"]):
-                            continue
-                    t = cells2df(
-                        c["cells"][np.vectorize(lambda cell: cell[3] != 16)(c["cells"])]
-                    )
-                    if c["kind"] not in traces:
-                        traces[c["kind"]] = []
-                    traces[c["kind"]].append(t)
-
-                process_kinds(kinds, uuid, tag, traces, labels, dataset)
-
-    return labels, dataset
-
-
-def get_pickle_list(dir):
-    return sorted([f for f in os.listdir(dir) if f.endswith(".pickle")])
-
-
-print("listing files...")
-clearnet_files = get_pickle_list("clearnet")
-onion_files = get_pickle_list("onion")
-curl_files = get_pickle_list("curl")
-
-# general
-print("extracting clearnet-only-general.npz...")
-labels, dataset = extract_dataset([KIND_GENERAL], clearnet_files, "clearnet")
-np.savez_compressed("clearnet-only-general.npz", labels=labels, dataset=dataset)
-print("saved to clearnet-only-general.npz")
-
-print("extracting clearnet-no-general.npz...")
-labels, dataset = extract_dataset(
-    [KIND_HSDIR, KIND_INTRO, KIND_REND], clearnet_files, "clearnet"
-)
-np.savez_compressed("clearnet-no-general.npz", labels=labels, dataset=dataset)
-print("saved to clearnet-no-general.npz")
-
-# hsdir
-print("extracting onion-only-hsdir.npz...")
-labels, dataset = extract_dataset([KIND_HSDIR], onion_files, "onion")
-np.savez_compressed("onion-only-hsdir.npz", labels=labels, dataset=dataset)
-print("saved to onion-only-hsdir.npz")
-
-print("extracting onion-no-hsdir.npz...")
-labels, dataset = extract_dataset(
-    [KIND_GENERAL, KIND_INTRO, KIND_REND], onion_files, "onion"
-)
-np.savez_compressed("onion-no-hsdir.npz", labels=labels, dataset=dataset)
-print("saved to onion-no-hsdir.npz")
-
-# intro
-print("extracting onion-only-intro.npz...")
-labels, dataset = extract_dataset([KIND_INTRO], onion_files, "onion")
-np.savez_compressed("onion-only-intro.npz", labels=labels, dataset=dataset)
-print("saved to onion-only-intro.npz")
-
-print("extracting onion-no-intro.npz...")
-labels, dataset = extract_dataset(
-    [KIND_GENERAL, KIND_HSDIR, KIND_REND], onion_files, "onion"
-)
-np.savez_compressed("onion-no-intro.npz", labels=labels, dataset=dataset)
-print("saved to onion-no-intro.npz")
-
-# rend
-print("extracting onion-only-rend.npz...")
-labels, dataset = extract_dataset([KIND_REND], onion_files, "onion")
-np.savez_compressed("onion-only-rend.npz", labels=labels, dataset=dataset)
-print("saved to onion-only-rend.npz")
-
-print("extracting onion-no-rend.npz...")
-labels, dataset = extract_dataset(
-    [KIND_GENERAL, KIND_HSDIR, KIND_INTRO], onion_files, "onion"
-)
-np.savez_compressed("onion-no-rend.npz", labels=labels, dataset=dataset)
-print("saved to onion-no-rend.npz")
-
-# curl (ok, not circuit fingerprinting, but we just need to extract it
-# somewhere)
-print("extracting curl-only-general.npz...")
-labels, dataset = extract_dataset([KIND_GENERAL], curl_files, "curl")
-np.savez_compressed("curl-only-general.npz", labels=labels, dataset=dataset)
-print("saved to curl-only-general.npz")
\ No newline at end of file
+            n = len(traces[kind])
+            rows.append(traces[kind].astype(np.int8))
+            tags.extend([tag] * n)
+            ids.extend(f"{uuid}-{kind}-{i}" for i in range(n))
+
+
+def extract_tag(job):
+    # (traces, tags, ids) of the circuits of the given kinds of one tag file
+    kinds, name, f, c = job
+    rows, tags, ids = [], [], []
+    tag, selected_circuits = load_tag(os.path.join(name, f))
+    # only the circuits kept below are featurized
+    assert len(c["kind"]) == len(selected_circuits)
+    selected_circuits = selected_circuits[
+        np.isin(c["kind"], kinds) & ~((c["kind"] == KIND_GENERAL) & c["dir"])
+    ]
+    all_traces, all_dir = featurize(selected_circuits, LENGTH)
+
+    for f, circuits, fetch_traces, fetch_dir in group_by(
+        selected_circuits["fetch"], selected_circuits, all_traces, all_dir
+    ):
+        uuid = f"{name}-{tag}-{f}"
+
+        # kind -> traces, without directory circuits
+        keep = ~((circuits["kind"] == KIND_GENERAL) & fetch_dir)
+        traces = dict(group_by(circuits["kind"][keep], fetch_traces[keep]))
+
+        process_kinds(kinds, uuid, tag, traces, rows, tags, ids)
+
+    return np.concatenate(rows or [np.zeros((0, LENGTH), dtype=np.int8)]), tags, ids
+
+
+def extract_dataset(cache, kinds, index, name):
+    # (traces, tags, ids) of all circuits of the given kinds, for tracefile,
+    # the results of unchanged tag files from the cache
+    jobs = [
+        (kinds, name, f, circuitindex.features(index, i))
+        for i, f in enumerate(index["files"])
+    ]
+    keys = [
+        cache.key(
+            digest,
+            script="extract-cf",
+            version=CACHE_VERSION,
+            name=name,
+            LENGTH=LENGTH,
+            kinds=kinds,
+        )
+        for digest in index["digests"]
+    ]
+    rows, tags, ids = [], [], []
+    for tag_rows, tag_tags, tag_ids in cache.map(extract_tag, jobs, keys):
+        rows.append(tag_rows)
+        tags.extend(tag_tags)
+        ids.extend(tag_ids)
+    return np.concatenate(rows or [np.zeros((0, LENGTH), dtype=np.int8)]), tags, ids
+
+
+def main(args):
+    cache = ResultCache(None if args.no_cache else args.cache, args.cache_size << 20)
+
+    print("indexing files...")
+    clearnet_index = circuitindex.load("clearnet")
+    onion_index = circuitindex.load("onion")
+    curl_index = circuitindex.load("curl")
+
+    # general
+    print("extracting clearnet-only-general.npz...")
+    traces, tags, ids = extract_dataset(
+        cache, [KIND_GENERAL], clearnet_index, "clearnet"
+    )
+    tracefile.save("clearnet-only-general.npz", traces, tags, ids)
+    print("saved to clearnet-only-general.npz")
+
+    print("extracting clearnet-no-general.npz...")
+    traces, tags, ids = extract_dataset(
+        cache, [KIND_HSDIR, KIND_INTRO, KIND_REND], clearnet_index, "clearnet"
+    )
+    tracefile.save("clearnet-no-general.npz", traces, tags, ids)
+    print("saved to clearnet-no-general.npz")
+
+    # hsdir
+    print("extracting onion-only-hsdir.npz...")
+    traces, tags, ids = extract_dataset(cache, [KIND_HSDIR], onion_index, "onion")
+    tracefile.save("onion-only-hsdir.npz", traces, tags, ids)
+    print("saved to onion-only-hsdir.npz")
+
+    print("extracting onion-no-hsdir.npz...")
+    traces, tags, ids = extract_dataset(
+        cache, [KIND_GENERAL, KIND_INTRO, KIND_REND], onion_index, "onion"
+    )
+    tracefile.save("onion-no-hsdir.npz", traces, tags, ids)
+    print("saved to onion-no-hsdir.npz")
+
+    # intro
+    print("extracting onion-only-intro.npz...")
+    traces, tags, ids = extract_dataset(cache, [KIND_INTRO], onion_index, "onion")
+    tracefile.save("onion-only-intro.npz", traces, tags, ids)
+    print("saved to onion-only-intro.npz")
+
+    print("extracting onion-no-intro.npz...")
+    traces, tags, ids = extract_dataset(
+        cache, [KIND_GENERAL, KIND_HSDIR, KIND_REND], onion_index, "onion"
+    )
+    tracefile.save("onion-no-intro.npz", traces, tags, ids)
+    print("saved to onion-no-intro.npz")
+
+    # rend
+    print("extracting onion-only-rend.npz...")
+    traces, tags, ids = extract_dataset(cache, [KIND_REND], onion_index, "onion")
+    tracefile.save("onion-only-rend.npz", traces, tags, ids)
+    print("saved to onion-only-rend.npz")
+
+    print("extracting onion-no-rend.npz...")
+    traces, tags, ids = extract_dataset(
+        cache, [KIND_GENERAL, KIND_HSDIR, KIND_INTRO], onion_index, "onion"
+    )
+    tracefile.save("onion-no-rend.npz", traces, tags, ids)
+    print("saved to onion-no-rend.npz")
+
+    # curl (ok, not circuit fingerprinting, but we just need to extract it
+    # somewhere)
+    print("extracting curl-only-general.npz...")
+    traces, tags, ids = extract_dataset(cache, [KIND_GENERAL], curl_index, "curl")
+    tracefile.save("curl-only-general.npz", traces, tags, ids)
+    print("saved to curl-only-general.npz")
+
+    print(f"{cache.hits} tag files from the cache, {cache.misses} extracted")
+    cache.trim()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract circuit fingerprinting classes"
+    )
+    parser.add_argument(
+        "--cache",
+        default=DIRECTORY,
+        help="directory of the per-tag-file cache of extracted traces",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=MAX_BYTES >> 20,
+        help="size cap of the cache in MiB, least recently used traces are removed",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="extract all tag files, store nothing"
+    )
+    args = parser.parse_args()
+    main(args)
@@ -1,232 +1,298 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import numpy as np
-import pickle
+import circuitindex
+import tracefile
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from circuitstore import load_tag
+from resultcache import DIRECTORY, MAX_BYTES, ResultCache
+from traces import (
+    LENGTH,
+    KIND_GENERAL,
+    KIND_REND,
+    FILTERED_DOMAINS,
+    CF_DOMAINS,
+    featurize,
+    group_by,
+    largest_trace,
+    trace_lengths,
+)
 
-# DF trace representation length
-LENGTH = 5000
 HALF = int(LENGTH / 2)
 
-KIND_GENERAL = 0
-KIND_HSDIR = 1
-KIND_INTRO = 2
-KIND_REND = 3
-
-FILTERED_DOMAINS = [
-    b"securedrop.org",
-    b"185.220.103.112",
-    b"185.220.103.119",
-]
-
-CF_DOMAINS = [
-    b"cflaresuje2rb7w2u3w43pn4luxdi6o7oatv6r2zrfb5xvsugj35d2qd.onion",
-    b"cflarexljc3rw355ysrkrzwapozws6nre6xsy3n4yrj7taye3uiby3ad.onion",
-    b"cflarenuttlfuyn7imozr4atzvfbiw3ezgbdjdldmdx7srterayaozid.onion",
-    b"cflareki4v3lh674hq55k3n7xd4ibkwx3pnw67rr3gkpsonjmxbktxyd.onion",
-    b"cflareub6dtu7nvs3kqmoigcjdwap2azrkx5zohb2yk7gqjkwoyotwqd.onion",
-    b"cflareusni3s7vwhq2f7gc4opsik7aa4t2ajedhzr42ez6uajaywh3qd.onion",
-    b"cflareer7qekzp3zeyqvcfktxfrmncse4ilc7trbf6bp6yzdabxuload.onion",
-    b"cflares35lvdlczhy3r6qbza5jjxbcplzvdveabhf7bsp7y4nzmn67yd.onion",
-    b"cflarejlah424meosswvaeqzb54rtdetr4xva6mq2bm2hfcx5isaglid.onion",
-    b"cflare2nge4h4yqr3574crrd7k66lil3torzbisz6uciyuzqc2h2ykyd.onion",
-    b"cloudflare.com",
-]
-
-
-def cells2df(cells, length=LENGTH):
-    data = np.zeros((1, length), dtype=np.float32)
-    cell_directions = cells["direction"].astype(np.float32)
-    data[0, : len(cell_directions)] = cell_directions[:length]
-    return data
-
-
-def is_dir_circuit(cells):
-    for cell in cells:
-        if cell["relay_cmd"] == 13:
-            return True
-    return False
-
-
-def get_max_nonzero_trace(traces):
-    max_trace = None
-    max_trace_len = -1
-    for t in traces:
-        if get_trace_length(t) > max_trace_len:
-            max_trace = t
-            max_trace_len = get_trace_length(t)
-    return max_trace
-
-
-def get_trace_length(trace):
-    return len(np.nonzero(trace)[0])
-
-
-def extract_ol_format(files, name, MIN_NONZERO_CELLS=200, POSITIVE_CLASS=False):
-    labels, dataset = {}, {}
-    for i, f in enumerate(files):
-        with open(os.path.join(name, f), "rb") as file:
-            (tag, selected_circuits) = pickle.load(file)
-
-            fetches = np.unique(selected_circuits["fetch"])
-            for f in fetches:
-                uuid = f"{name}-{tag}-{f}"
-                circuits = selected_circuits[selected_circuits["fetch"] == f]
-
-                # kind -> list of traces
-                traces = {}
-                for c in circuits:
-                    if c["domain"] in FILTERED_DOMAINS or (
-                        POSITIVE_CLASS and c["domain"] in CF_DOMAINS
-                    ):
-                        continue
-                    if c["kind"] == KIND_GENERAL:
-                        if is_dir_circuit(c["cells"]):
-                            continue
-                    t = cells2df(
-                        c["cells"][np.vectorize(lambda cell: cell[3] != 16)(c["cells"])]
-                    )
-                    if c["kind"] not in traces:
-                        traces[c["kind"]] = []
-                    traces[c["kind"]].append(t)
-
-                if KIND_GENERAL not in traces or KIND_REND not in traces:
-                    # only want fetches that might have done something
-                    continue
-
-                # can the attacker collect correctly labeled data on its own? yes!
-                if POSITIVE_CLASS:
-                    largest_general = get_max_nonzero_trace(traces[KIND_GENERAL])
-                    largest_general_len = get_trace_length(largest_general)
-                    largest_rend = get_max_nonzero_trace(traces[KIND_REND])
-                    largest_rend_len = get_trace_length(largest_rend)
-
-                    # make sure we have at least X non-zero cells on both loads
-                    if (
-                        largest_general_len < MIN_NONZERO_CELLS
-                        or largest_rend_len < MIN_NONZERO_CELLS
-                    ):
-                        continue
-
-                    labels[uuid] = tag
-                    # concatenate the the first HALF cells from the traces
-                    dataset[uuid] = np.concatenate(
-                        (largest_general[:, :HALF], largest_rend[:, :HALF]), axis=1
-                    )
-                else:
-                    # negative class: we use every possible combination of
-                    # general and rend circuits
-                    i = 0
-                    for general in traces[KIND_GENERAL]:
-                        for rend in traces[KIND_REND]:
-                            ID = f"{uuid}-{i}"
-                            labels[ID] = tag
-                            dataset[ID] = np.concatenate(
-                                (general[:, :HALF], rend[:, :HALF]), axis=1
-                            )
-                            i += 1
-                    pass
-
-    return labels, dataset
-
-
-def extract_negative_autoloc(clearnet_files, onion_files, MIN_NONZERO_CELLS=0):
-    # find all clearnet general circuits (and not dir)
-    clearnet_general_circuits = []
-    for i, f in enumerate(clearnet_files):
-        with open(os.path.join("clearnet", f), "rb") as file:
-            (tag, selected_circuits) = pickle.load(file)
-
-            fetches = np.unique(selected_circuits["fetch"])
-            for f in fetches:
-                circuits = selected_circuits[selected_circuits["fetch"] == f]
-                traces = {}
-                for c in circuits:
-                    if c["kind"] == KIND_GENERAL:
-                        if is_dir_circuit(c["cells"]):
-                            continue
-                        t = cells2df(
-                            c["cells"][
-                                np.vectorize(lambda cell: cell[3] != 16)(c["cells"])
-                            ]
-                        )
-                        if c["kind"] not in traces:
-                            traces[c["kind"]] = []
-                        traces[c["kind"]].append(t)
-                        if get_trace_length(t) >= MIN_NONZERO_CELLS:
-                            clearnet_general_circuits.append(t)
-
-    # find all onion rend circuits
-    onion_rend_circuits = []
-    for i, f in enumerate(onion_files):
-        with open(os.path.join("onion", f), "rb") as file:
-            (tag, selected_circuits) = pickle.load(file)
-
-            fetches = np.unique(selected_circuits["fetch"])
-            for f in fetches:
-                circuits = selected_circuits[selected_circuits["fetch"] == f]
-                traces = {}
-                for c in circuits:
-                    if c["kind"] == KIND_REND:
-                        t = cells2df(
-                            c["cells"][
-                                np.vectorize(lambda cell: cell[3] != 16)(c["cells"])
-                            ]
-                        )
-                        if c["kind"] not in traces:
-                            traces[c["kind"]] = []
-                        traces[c["kind"]].append(t)
-                        if get_trace_length(t) >= MIN_NONZERO_CELLS:
-                            onion_rend_circuits.append(t)
+# minimum non-zero cells of the circuits in the negative autoloc set
+MIN_NEGATIVE_CELLS = 100
+
+# part of the cache keys, bump it when the cached per-tag results change
+CACHE_VERSION = 1
+
+
+def extract_tag(job):
+    # Parses one tag file and returns (samples, negatives). For the positive
+    # class, samples are (traces, tags, ids, sizes): one int8 trace per uuid
+    # and the smallest of the largest general and rend circuit per uuid (to
+    # apply every min size after the fact). Otherwise samples are the compact
+    # pairs (general, rend, pairs, tags), see merge_pairs(). Negatives are the
+    # first HALF cells of all traces of NEGATIVE_KIND with at least
+    # MIN_NEGATIVE_CELLS non-zero cells (for the negative autoloc set).
+    name, f, c, excluded, POSITIVE_CLASS, NEGATIVE_KIND = job
+    positive, ids, sizes, negatives = [], [], [], []
+    general, rend, pairs, pair_tags = [], [], [], []
+    n_general, n_rend = 0, 0
+
+    tag, selected_circuits = load_tag(os.path.join(name, f))
+    # only the circuits used below are featurized, selected by their
+    # circuitindex features c, and circuits to the excluded domain ids are
+    # skipped
+    assert len(c["kind"]) == len(selected_circuits)
+    excluded = np.isin(c["domain"], excluded)
+    general_dir = (c["kind"] == KIND_GENERAL) & c["dir"]
+    used = np.isin(c["kind"], [KIND_GENERAL, KIND_REND]) & ~general_dir & ~excluded
+    if NEGATIVE_KIND is not None:
+        negative = c["kind"] == NEGATIVE_KIND
+        if NEGATIVE_KIND == KIND_GENERAL:
+            negative &= ~c["dir"]
+        used |= negative & (np.minimum(c["cells"], LENGTH) >= MIN_NEGATIVE_CELLS)
+    selected_circuits = selected_circuits[used]
+    all_traces, all_dir = featurize(selected_circuits)
+
+    for f, circuits, fetch_traces, fetch_dir, fetch_excluded in group_by(
+        selected_circuits["fetch"],
+        selected_circuits,
+        all_traces,
+        all_dir,
+        excluded[used],
+    ):
+        uuid = f"{name}-{tag}-{f}"
+
+        # general circuits (and not dir) or rend circuits, of any domain
+        if NEGATIVE_KIND is not None:
+            negative = circuits["kind"] == NEGATIVE_KIND
+            if NEGATIVE_KIND == KIND_GENERAL:
+                negative &= ~fetch_dir
+            t = fetch_traces[negative]
+            t = t[trace_lengths(t) >= MIN_NEGATIVE_CELLS]
+            negatives.append(t[:, :HALF].astype(np.int8))
+
+        skip = fetch_excluded | ((circuits["kind"] == KIND_GENERAL) & fetch_dir)
+
+        # kind -> traces
+        traces = dict(group_by(circuits["kind"][~skip], fetch_traces[~skip]))
+
+        if KIND_GENERAL not in traces or KIND_REND not in traces:
+            # only want fetches that might have done something
+            continue
+
+        # can the attacker collect correctly labeled data on its own? yes!
+        if POSITIVE_CLASS:
+            largest_general, largest_general_len = largest_trace(traces[KIND_GENERAL])
+            largest_rend, largest_rend_len = largest_trace(traces[KIND_REND])
+
+            ids.append(uuid)
+            sizes.append(min(largest_general_len, largest_rend_len))
+            # concatenate the the first HALF cells from the traces
+            positive.append(
+                np.concatenate(
+                    (largest_general[:, :HALF], largest_rend[:, :HALF]), axis=1
+                ).astype(np.int8)
+            )
+        else:
+            # negative class: we use every possible combination of general
+            # and rend circuits, stored as the first HALF cells of each circuit
+            # once and the (general, rend) index of every combination
+            g, r = traces[KIND_GENERAL], traces[KIND_REND]
+            general.append(g[:, :HALF].astype(np.int8))
+            rend.append(r[:, :HALF].astype(np.int8))
+            gi, ri = np.meshgrid(
+                np.arange(len(g)) + n_general, np.arange(len(r)) + n_rend, indexing="ij"
+            )
+            pairs.append(np.stack((gi.ravel(), ri.ravel()), axis=1))
+            pair_tags.extend([tag] * (len(g) * len(r)))
+            n_general += len(g)
+            n_rend += len(r)
+
+    negatives = np.concatenate(negatives or [np.zeros((0, HALF), dtype=np.int8)])
+    if POSITIVE_CLASS:
+        return (
+            np.concatenate(positive or [np.zeros((0, LENGTH), dtype=np.int8)]),
+            [tag] * len(ids),
+            ids,
+            np.array(sizes, dtype=np.int64),
+        ), negatives
+    return (
+        np.concatenate(general or [np.zeros((0, HALF), dtype=np.int8)]),
+        np.concatenate(rend or [np.zeros((0, HALF), dtype=np.int8)]),
+        np.concatenate(pairs or [np.zeros((0, 2), dtype=np.int64)]),
+        pair_tags,
+    ), negatives
+
+
+def extract(executor, cache, name, POSITIVE_CLASS=False, NEGATIVE_KIND=None):
+    # parse every tag file of a dataset once, spread over the executor, or
+    # load its results from the cache (min sizes are applied after the fact,
+    # in merge(), so MIN_NONZERO_CELLS is not part of the key)
+    index = circuitindex.load(name, executor)
+    # FILTERED_DOMAINS, and CF_DOMAINS for the positive class, by id
+    excluded_domains = FILTERED_DOMAINS + (CF_DOMAINS if POSITIVE_CLASS else [])
+    excluded = circuitindex.domain_ids(index, excluded_domains)
+    jobs = [
+        (
+            name,
+            f,
+            circuitindex.features(index, i),
+            excluded,
+            POSITIVE_CLASS,
+            NEGATIVE_KIND,
+        )
+        for i, f in enumerate(index["files"])
+    ]
+    keys = [
+        cache.key(
+            digest,
+            script="extract-ol",
+            version=CACHE_VERSION,
+            name=name,
+            LENGTH=LENGTH,
+            MIN_NEGATIVE_CELLS=MIN_NEGATIVE_CELLS,
+            excluded=excluded_domains,
+            POSITIVE_CLASS=POSITIVE_CLASS,
+            NEGATIVE_KIND=NEGATIVE_KIND,
+        )
+        for digest in index["digests"]
+    ]
+    return cache.map(
+        extract_tag,
+        jobs,
+        keys,
+        lambda f, jobs: tqdm(executor.map(f, jobs), total=len(jobs)),
+    )
+
+
+def merge(results, MIN_NONZERO_CELLS):
+    # (traces, tags, ids) of all tags, keeping uuids with at least
+    # MIN_NONZERO_CELLS non-zero cells on both loads
+    traces, tags, ids = [], [], []
+    for (tag_traces, tag_tags, tag_ids, sizes), _ in results:
+        keep = np.flatnonzero(sizes >= MIN_NONZERO_CELLS)
+        traces.append(tag_traces[keep])
+        tags.extend(tag_tags[i] for i in keep)
+        ids.extend(tag_ids[i] for i in keep)
+    return np.concatenate(traces or [np.zeros((0, LENGTH), dtype=np.int8)]), tags, ids
+
+
+def merge_pairs(results):
+    # Compact negative class: int8 general and rend halves (HALF cells each)
+    # and for every sample the index of its general and rend half, so sample i
+    # is the concatenation of general[pairs[i, 0]] and rend[pairs[i, 1]].
+    general, rend, pairs, tags = [], [], [], []
+    n_general, n_rend = 0, 0
+    for (g, r, p, t), _ in results:
+        general.append(g)
+        rend.append(r)
+        pairs.append(p + [n_general, n_rend])
+        tags.extend(t)
+        n_general += len(g)
+        n_rend += len(r)
+    return (
+        np.concatenate(general or [np.zeros((0, HALF), dtype=np.int8)]),
+        np.concatenate(rend or [np.zeros((0, HALF), dtype=np.int8)]),
+        np.concatenate(pairs or [np.zeros((0, 2), dtype=np.int64)]).astype(np.int32),
+        np.array(tags),
+    )
+
+
+def extract_negative_autoloc(clearnet_results, onion_results):
+    empty = [np.zeros((0, HALF), dtype=np.int8)]
+    clearnet_general_circuits = np.concatenate(
+        [r[1] for r in clearnet_results] or empty
+    )
+    onion_rend_circuits = np.concatenate([r[1] for r in onion_results] or empty)
 
     # shuffle both
     np.random.shuffle(clearnet_general_circuits)
     np.random.shuffle(onion_rend_circuits)
 
     # merge
-    labels, dataset = {}, {}
-    for i in range(min(len(clearnet_general_circuits), len(onion_rend_circuits))):
-        uuid = f"negative-{i}"
-        labels[uuid] = 0
-        dataset[uuid] = np.concatenate(
-            (
-                clearnet_general_circuits[i][:, :HALF],
-                onion_rend_circuits[i][:, :HALF],
-            ),
-            axis=1,
-        )
-
-    return labels, dataset
-
+    n = min(len(clearnet_general_circuits), len(onion_rend_circuits))
+    traces = np.concatenate(
+        (clearnet_general_circuits[:n], onion_rend_circuits[:n]), axis=1
+    )
+    return traces, [0] * n, [f"negative-{i}" for i in range(n)]
 
-def get_pickle_list(dir):
-    return sorted([f for f in os.listdir(dir) if f.endswith(".pickle")])
 
-
-def save(name, m, labels, dataset):
+def save(name, m, traces, tags, ids):
     FNAME = f"{name}-{m}.npz"
-    np.savez_compressed(FNAME, labels=labels, dataset=dataset)
+    # every sample is a general and a rend circuit of HALF cells each
+    tracefile.save(FNAME, traces, tags, ids, circuit_width=HALF)
     print(f"saved to {FNAME}")
 
 
-print("listing files...")
-autoloc_files = get_pickle_list("autoloc")
-clearnet_files = get_pickle_list("clearnet")
-onion_files = get_pickle_list("onion")
-
-min_positive_sizes = [30, 35, 50, 75, 100]
-for m in min_positive_sizes:
-    print(f"extracting autoloc, min size {m}...")
-    labels, dataset = extract_ol_format(autoloc_files, "autoloc", m, True)
-    save("autoloc", m, labels, dataset)
-
-print("extracting clearnet...")
-labels, dataset = extract_ol_format(clearnet_files, "clearnet", 0, False)
-save("clearnet-ol", 0, labels, dataset)
+def save_pairs(name, m, general, rend, pairs, tags):
+    # general and rend halves as rows of one trace file, rend rows after the
+    # general ones
+    FNAME = f"{name}-{m}.npz"
+    tracefile.save(
+        FNAME,
+        np.concatenate((general, rend)),
+        tags,
+        pairs=pairs + [0, len(general)],
+        circuit_width=HALF,
+    )
+    print(f"saved {len(pairs)} pairs of {len(general)} general and {len(rend)} rend")
+    print(f"saved to {FNAME}")
 
-print("extracting onion...")
-labels, dataset = extract_ol_format(onion_files, "onion", 0, False)
-save("onion-ol", 0, labels, dataset)
 
-print("extracting negative autoloc...")
-labels, dataset = extract_negative_autoloc(clearnet_files, onion_files, 100)
-save("negative-ol", 100, labels, dataset)
+def main(args):
+    cache = ResultCache(None if args.no_cache else args.cache, args.cache_size << 20)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        print("extracting autoloc...")
+        autoloc = extract(executor, cache, "autoloc", True)
+        print("extracting clearnet...")
+        clearnet = extract(executor, cache, "clearnet", False, KIND_GENERAL)
+        print("extracting onion...")
+        onion = extract(executor, cache, "onion", False, KIND_REND)
+    print(f"{cache.hits} tag files from the cache, {cache.misses} extracted")
+    cache.trim()
+
+    min_positive_sizes = [30, 35, 50, 75, 100]
+    for m in min_positive_sizes:
+        print(f"merging autoloc, min size {m}...")
+        save("autoloc", m, *merge(autoloc, m))
+
+    print("merging clearnet...")
+    save_pairs("clearnet-ol", 0, *merge_pairs(clearnet))
+
+    print("merging onion...")
+    save_pairs("onion-ol", 0, *merge_pairs(onion))
+
+    print("merging negative autoloc...")
+    save("negative-ol", MIN_NEGATIVE_CELLS, *extract_negative_autoloc(clearnet, onion))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract onion-location classes")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes",
+    )
+    parser.add_argument(
+        "--cache",
+        default=DIRECTORY,
+        help="directory of the per-tag-file cache of extracted traces",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=MAX_BYTES >> 20,
+        help="size cap of the cache in MiB, least recently used traces are removed",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="extract all tag files, store nothing"
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,274 @@
+import os
+from collections import OrderedDict
+import h5py
+import numpy as np
+import torch
+from tqdm import tqdm
+from circuitstore import from_records
+from traces import (
+    CF_DOMAINS,
+    FILTERED_DOMAINS,
+    KIND_GENERAL,
+    KIND_HSDIR,
+    KIND_INTRO,
+    KIND_REND,
+    LENGTH,
+    featurize,
+    group_by,
+)
+
+# Circuit traces straight from the compound datasets of onionloc.hdf5, without
+# the tag files of dataset-to-files.py and the trace files of extract-*.py.
+# One pass over a dataset builds an index of every circuit (its tag, fetch,
+# kind, whether its domain is filtered and whether it is a directory circuit),
+# saved next to the hdf5 file. Samples are then featurized from blocks of rows
+# read on demand, kept in an LRU cache.
+
+# rows read from the hdf5 file at a time
+BLOCK_ROWS = 4096
+
+KINDS = dict(general=KIND_GENERAL, hsdir=KIND_HSDIR, intro=KIND_INTRO, rend=KIND_REND)
+
+
+def index_path(path, dataset):
+    return f"{path}.{dataset}.index.npz"
+
+
+def build_index(path, dataset):
+    # one pass over all rows of dataset, see load_index()
+    with h5py.File(path, "r") as f:
+        raw = f[dataset]
+        tags = raw.fields("tag")[:]
+        if tags.dtype == object:
+            # variable length strings, as fixed width bytes
+            tags = np.array(tags.tolist())
+        tags, tag_ids = np.unique(tags, return_inverse=True)
+        columns = dict(fetch=[], kind=[], time_created=[], filtered=[], cf=[], dir=[])
+        for start in tqdm(range(0, len(raw), BLOCK_ROWS), unit="block"):
+            circuits = from_records(raw[start : start + BLOCK_ROWS])
+            for name in ("fetch", "kind", "time_created"):
+                columns[name].append(circuits[name])
+            columns["filtered"].append(np.isin(circuits["domain"], FILTERED_DOMAINS))
+            columns["cf"].append(np.isin(circuits["domain"], CF_DOMAINS))
+            columns["dir"].append(featurize(circuits, 1)[1])
+    index = {name: np.concatenate(c) for name, c in columns.items()}
+    # without h5py metadata, it cannot be saved to .npz
+    index.update(tags=tags.astype(tags.dtype.str), tag_ids=tag_ids.astype(np.int32))
+    return index
+
+
+def load_index(path, dataset):
+    # dict of per-row columns tag_ids (into tags), fetch, kind, time_created,
+    # filtered (FILTERED_DOMAINS), cf (CF_DOMAINS) and dir, built once
+    p = index_path(path, dataset)
+    if not os.path.exists(p):
+        print(f"indexing {dataset} of {path}...")
+        # write to a temporary file, read it back and rename, an existing
+        # index is complete and loads
+        np.savez(f"{p}.tmp.npz", **build_index(path, dataset))
+        with np.load(f"{p}.tmp.npz") as npz:
+            index = {name: npz[name] for name in npz.files}
+        os.replace(f"{p}.tmp.npz", p)
+        return index
+    with np.load(p) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def select(index, kinds, filtered=False, cf=False):
+    # Rows of the circuits of the given kinds, without general directory
+    # circuits (as in extract-*.py) and optionally without circuits to
+    # FILTERED_DOMAINS and CF_DOMAINS. Ordered by tag, fetch, kind (in the
+    # order of kinds) and time created, as extract-cf.py orders a tag file.
+    kind = index["kind"]
+    keep = np.isin(kind, kinds) & ~((kind == KIND_GENERAL) & index["dir"])
+    if filtered:
+        keep &= ~index["filtered"]
+    if cf:
+        keep &= ~index["cf"]
+    rows = np.flatnonzero(keep)
+    rank = np.zeros(max(kinds) + 1, dtype=np.int64)
+    rank[kinds] = np.arange(len(kinds))
+    order = np.lexsort(
+        (
+            rows,
+            index["time_created"][rows],
+            rank[kind[rows]],
+            index["fetch"][rows],
+            index["tag_ids"][rows],
+        )
+    )
+    return rows[order]
+
+
+def select_pairs(index, rows):
+    # (n, 2) positions in rows (see select()) of the general and rend circuit
+    # of every combination of a general and a rend circuit of one fetch, as
+    # the negative class of extract-ol.py, in the order of rows
+    tag_ids, fetch, kind = (index[c][rows] for c in ("tag_ids", "fetch", "kind"))
+    new = (tag_ids[1:] != tag_ids[:-1]) | (fetch[1:] != fetch[:-1])
+    pairs = []
+    for at in np.split(np.arange(len(rows)), np.flatnonzero(new) + 1):
+        g, r = at[kind[at] == KIND_GENERAL], at[kind[at] == KIND_REND]
+        gi, ri = np.meshgrid(g, r, indexing="ij")
+        pairs.append(np.stack((gi.ravel(), ri.ravel()), axis=1))
+    return np.concatenate(pairs or [np.zeros((0, 2), dtype=np.int64)])
+
+
+def block_shuffle(blocks, window):
+    # A shuffled order of samples in the given blocks that reads every block
+    # once: blocks are shuffled, and the samples of window blocks at a time
+    # are shuffled together. Uses the torch RNG, as DataLoader samplers do.
+    groups = [s for _, s in group_by(blocks, np.arange(len(blocks)))]
+    groups = [groups[i] for i in torch.randperm(len(groups)).tolist()]
+    order = []
+    for start in range(0, len(groups), window):
+        samples = np.concatenate(groups[start : start + window])
+        order.append(samples[torch.randperm(len(samples)).numpy()])
+    return np.concatenate(order or [np.zeros(0, dtype=np.int64)])
+
+
+class HDF5Traces(torch.utils.data.Dataset):
+    # The DF traces (int8, length cells) of the circuits of the given kinds
+    # in one dataset of an hdf5 file, see select(), as a map-style dataset
+    # of (trace, label). With pairs, samples are instead every general and
+    # rend circuit of a fetch (see select_pairs()), the first ceil(length / 2)
+    # cells of each concatenated. tags has the tag of every sample. Circuits
+    # are read and featurized BLOCK_ROWS rows of the file at a time, the
+    # traces of the cache_blocks most recently used blocks are kept. Use get()
+    # or a DataLoader (which calls __getitems__ per batch) to read each block
+    # once per batch, and BlockSampler to read each block once per epoch.
+    def __init__(
+        self,
+        path,
+        dataset,
+        kinds,
+        length=LENGTH,
+        label=0,
+        filtered=False,
+        cf=False,
+        pairs=False,
+        cache_blocks=16,
+    ):
+        index = load_index(path, dataset)
+        self.rows = select(index, kinds, filtered, cf)
+        self.pairs = select_pairs(index, self.rows) if pairs else None
+        self.path = path
+        self.dataset = dataset
+        self.length = length
+        # cells of the trace of a circuit
+        self.width = -(-length // 2) if pairs else length
+        self.label = label
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()
+        self.file = None
+
+        # the block of every circuit and its position among the selected rows
+        # of the block (in file order)
+        self.blocks = self.rows // BLOCK_ROWS
+        order = np.argsort(self.rows, kind="stable")
+        first = np.searchsorted(self.blocks[order], self.blocks[order], side="left")
+        self.slots = np.empty(len(self.rows), dtype=np.int64)
+        self.slots[order] = np.arange(len(self.rows)) - first
+        self.block_rows = dict(
+            (b, rows) for b, rows in group_by(self.blocks[order], self.rows[order])
+        )
+
+        # the tag and block (of its general circuit) of every sample
+        circuits = self.rows if self.pairs is None else self.rows[self.pairs[:, 0]]
+        self.tags = index["tags"][index["tag_ids"][circuits]]
+        self.sample_blocks = circuits // BLOCK_ROWS
+
+    def __len__(self):
+        return len(self.tags)
+
+    def raw(self):
+        # the hdf5 dataset, opened once per process (handles do not survive
+        # a fork)
+        if self.file is None or self.file[1] != os.getpid():
+            self.file = (h5py.File(self.path, "r"), os.getpid())
+        return self.file[0][self.dataset]
+
+    def __getstate__(self):
+        # for spawned DataLoader workers, without the file and cache
+        return dict(self.__dict__, file=None, cache=OrderedDict())
+
+    def block(self, b):
+        # int8 traces of the selected rows of block b
+        if b in self.cache:
+            self.cache.move_to_end(b)
+            return self.cache[b]
+        rows = self.block_rows[b]
+        circuits = from_records(self.raw()[rows[0] : rows[-1] + 1])
+        traces, _ = featurize(circuits[rows - rows[0]], self.width)
+        self.cache[b] = traces.astype(np.int8)
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return self.cache[b]
+
+    def circuit_traces(self, circuits):
+        # int8 (len(circuits), width) traces of circuits (positions in rows),
+        # each block read once
+        circuits = np.asarray(circuits, dtype=np.int64)
+        x = np.zeros((len(circuits), self.width), dtype=np.int8)
+        for b, at in group_by(self.blocks[circuits], np.arange(len(circuits))):
+            x[at] = self.block(b)[self.slots[circuits[at]]]
+        return x
+
+    def get(self, indices):
+        # int8 (len(indices), length) traces of samples
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.pairs is None:
+            return self.circuit_traces(indices)
+        p = self.pairs[indices]
+        x = np.concatenate(
+            (self.circuit_traces(p[:, 0]), self.circuit_traces(p[:, 1])), axis=1
+        )
+        return x[:, : self.length]
+
+    def __getitem__(self, i):
+        return torch.from_numpy(self.get([i])[0]), self.label
+
+    def __getitems__(self, indices):
+        x = torch.from_numpy(self.get(indices))
+        return [(x[j], self.label) for j in range(len(x))]
+
+
+class BlockSampler(torch.utils.data.Sampler):
+    # Shuffled order of the samples of an HDF5Traces that reads every block
+    # once per epoch, see block_shuffle(), with window (by default, the cache
+    # size) blocks shuffled together.
+    def __init__(self, dataset, window=None):
+        self.blocks = dataset.sample_blocks
+        self.window = window or dataset.cache_blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        yield from block_shuffle(self.blocks, self.window).tolist()
+
+
+def is_spec(name):
+    return ".hdf5:" in name
+
+
+def from_spec(spec, length=LENGTH):
+    # HDF5Traces of "FILE.hdf5:DATASET:KIND[,KIND...][:filtered|:filtered-cf]",
+    # e.g. onionloc.hdf5:clearnet:hsdir,intro,rend for clearnet-no-general.npz
+    # of extract-cf.py, with filtered (and cf) removing the circuits to
+    # FILTERED_DOMAINS (and CF_DOMAINS) as in extract-ol.py. The kinds
+    # general+rend are the pairs of general and rend circuits instead, e.g.
+    # onionloc.hdf5:clearnet:general+rend:filtered for clearnet-ol-0.npz.
+    path, dataset, kinds, *options = spec.split(":")
+    pairs = kinds == "general+rend"
+    if pairs:
+        kinds = [KIND_GENERAL, KIND_REND]
+    else:
+        kinds = [KINDS[k] for k in kinds.split(",")]
+    if options not in ([], ["filtered"], ["filtered-cf"]):
+        raise ValueError(f"invalid options in {spec}")
+    filtered = options in (["filtered"], ["filtered-cf"])
+    cf = options == ["filtered-cf"]
+    return HDF5Traces(
+        path, dataset, kinds, length, filtered=filtered, cf=cf, pairs=pairs
+    )
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import circuitindex
+
+
+def main():
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for dataset in args.datasets:
+            index = circuitindex.load(dataset, executor)
+            print(
+                f"{dataset}: {len(index['kind'])} circuits in {len(index['files'])} tag files, {circuitindex.index_path(dataset)}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Index the circuits of tag directories for dataset-stats.py and extract-*.py"
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of worker processes",
+    )
+    parser.add_argument(
+        "datasets",
+        nargs="*",
+        default=["clearnet", "onion", "autoloc", "curl"],
+        help="tag directories to index",
+    )
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,85 @@
+import numpy as np
+
+# Binary classification metrics from the score of the positive class for
+# every sample (e.g., its softmax probability) and whether the sample is
+# positive. In binary-classify.py the first dataset (label 0) is positive.
+
+
+def confusion(scores, positive, threshold=0.5):
+    # (tp, fp, fn, tn) when predicting positive for scores >= threshold
+    predicted = np.asarray(scores) >= threshold
+    cells = 2 * predicted + np.asarray(positive, dtype=bool)
+    tn, fn, fp, tp = np.bincount(cells, minlength=4)
+    return int(tp), int(fp), int(fn), int(tn)
+
+
+def ratio(a, b):
+    return a / b if b > 0 else float("nan")
+
+
+def rates(tp, fp, fn, tn):
+    return dict(
+        accuracy=ratio(tp + tn, tp + tn + fp + fn),
+        fpr=ratio(fp, fp + tn),
+        tpr=ratio(tp, tp + fn),
+        fnr=ratio(fn, fn + tp),
+        tnr=ratio(tn, tn + fp),
+    )
+
+
+def cumulative_counts(scores, positive):
+    # (tp, fp, thresholds): the number of true and false positives when
+    # thresholding at each distinct score, from the highest score down
+    scores = np.asarray(scores)
+    order = np.argsort(-scores, kind="stable")
+    scores = scores[order]
+    positive = np.asarray(positive, dtype=bool)[order]
+    # the last sample of each distinct score
+    last = np.flatnonzero(np.append(np.diff(scores) != 0, len(scores) > 0))
+    tp = np.cumsum(positive)[last]
+    fp = np.cumsum(~positive)[last]
+    return tp, fp, scores[last]
+
+
+def roc_curve(scores, positive):
+    # (fpr, tpr, thresholds), starting at (0, 0) for an infinite threshold
+    tp, fp, thresholds = cumulative_counts(scores, positive)
+    n_positive = np.count_nonzero(positive)
+    n_negative = len(positive) - n_positive
+    fpr = np.append(0, fp) / n_negative if n_negative else np.full(len(fp) + 1, np.nan)
+    tpr = np.append(0, tp) / n_positive if n_positive else np.full(len(tp) + 1, np.nan)
+    return fpr, tpr, np.append(np.inf, thresholds)
+
+
+def pr_curve(scores, positive):
+    # (precision, recall, thresholds) from the highest threshold down
+    tp, fp, thresholds = cumulative_counts(scores, positive)
+    n_positive = np.count_nonzero(positive)
+    precision = tp / (tp + fp)
+    recall = tp / n_positive if n_positive else np.full(len(tp), np.nan)
+    return precision, recall, thresholds
+
+
+def auc(x, y):
+    # area under the curve through the points (x, y), trapezoidal rule
+    x, y = np.asarray(x), np.asarray(y)
+    return float(np.sum(np.diff(x) * (y[1:] + y[:-1]) / 2))
+
+
+def average_precision(scores, positive):
+    # area under the PR curve as the recall-weighted mean of precisions
+    precision, recall, _ = pr_curve(scores, positive)
+    return float(np.sum(np.diff(np.append(0, recall)) * precision))
+
+
+def summary(scores, positive, threshold=0.5):
+    # rates and counts at threshold, and the threshold-free ROC AUC and
+    # average precision
+    tp, fp, fn, tn = confusion(scores, positive, threshold)
+    result = rates(tp, fp, fn, tn)
+    result.update(tp=tp, fp=fp, fn=fn, tn=tn)
+    fpr, tpr, _ = roc_curve(scores, positive)
+    result.update(
+        roc_auc=auc(fpr, tpr), average_precision=average_precision(scores, positive)
+    )
+    return result
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import socket
+import sys
+import time
+import numpy as np
+from circuitstore import list_tag_files, load_tag
+from traces import KIND_GENERAL, KIND_HSDIR, KIND_INTRO, KIND_REND, gather_cells
+
+# Replays extracted circuits as a stream of cell events for stream-classify.py,
+# one line per event:
+#   <circuit> <direction> <command>   a cell (command is the field featurize()
+#                                     drops cells by)
+#   <circuit> close                   the circuit closed
+# Circuit ids are <input>/<tag file>:<i> and contain no spaces.
+
+KINDS = dict(general=KIND_GENERAL, hsdir=KIND_HSDIR, intro=KIND_INTRO, rend=KIND_REND)
+
+
+def events(circuits, prefix):
+    # event lines of circuits, args.concurrent circuits open at a time with
+    # their cells interleaved round robin, each closed after its last cell
+    for start in range(0, len(circuits), args.concurrent):
+        group = circuits[start : start + args.concurrent]
+        cells, cid = gather_cells(group)
+        lengths = group.lengths()
+        pos = np.arange(len(cid)) - (np.cumsum(lengths) - lengths)[cid]
+        order = np.lexsort((cid, pos))
+        ids = [f"{prefix}:{start + i}" for i in range(len(group))]
+        lines = []
+        for c, p, d, m in zip(
+            cid[order].tolist(),
+            pos[order].tolist(),
+            cells["direction"][order].tolist(),
+            cells[cells.dtype.names[3]][order].tolist(),
+        ):
+            lines.append(f"{ids[c]} {d} {m}\n")
+            if p == lengths[c] - 1:
+                lines.append(f"{ids[c]} close\n")
+        # circuits without cells
+        lines.extend(f"{ids[c]} close\n" for c in np.flatnonzero(lengths == 0))
+        yield lines
+
+
+def main():
+    if args.socket:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(args.socket)
+        out = s.makefile("wb")
+    else:
+        out = sys.stdout.buffer
+
+    start = time.perf_counter()
+    sent = 0
+    for input in args.inputs:
+        for f in list_tag_files(input):
+            _, circuits = load_tag(os.path.join(input, f))
+            if args.kind != "all":
+                circuits = circuits[circuits["kind"] == KINDS[args.kind]]
+            prefix = (
+                f"{os.path.basename(os.path.normpath(input))}/{os.path.splitext(f)[0]}"
+            )
+            for lines in events(circuits, prefix):
+                out.write("".join(lines).encode())
+                sent += len(lines)
+                if args.rate:
+                    # no faster than rate events per second
+                    ahead = sent / args.rate - (time.perf_counter() - start)
+                    if ahead > 0:
+                        out.flush()
+                        time.sleep(ahead)
+    out.flush()
+    seconds = time.perf_counter() - start
+    print(
+        f"replayed {sent} events in {seconds:.1f}s, {sent / seconds:.0f} events/s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay extracted circuits as cell events for stream-classify.py"
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="directories with tag files (see dataset-to-files.py)"
+    )
+    parser.add_argument(
+        "-k",
+        "--kind",
+        choices=["all"] + list(KINDS),
+        default="general",
+        help="circuits of this kind only",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrent",
+        type=int,
+        default=100,
+        help="circuits open at a time, their cells interleaved",
+    )
+    parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=0,
+        help="events per second (default: as fast as possible)",
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        default=None,
+        help="unix socket of stream-classify.py (default: stdout)",
+    )
+    args = parser.parse_args()
+    main()
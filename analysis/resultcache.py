@@ -0,0 +1,107 @@
+import hashlib
+import os
+import pickle
+
+# A cache of per-tag-file results of dataset-stats.py and extract-*.py, one
+# pickle per result in a directory, keyed by the content digest of the tag
+# file (see circuitindex) and the parameters of the script, including the
+# version of its code. A rerun only processes the tag files that were added or
+# changed, or all of them if the parameters or the version changed. Results
+# read or written are touched, and trim() removes the least recently used ones
+# until the directory is within its size cap.
+DIRECTORY = ".resultcache"
+# size cap in bytes, by default
+MAX_BYTES = 10 << 30
+SUFFIX = ".pickle"
+
+
+def file_digest(path):
+    # sha256 of the contents of a tag file, a .circuits directory by the names
+    # and contents of its files
+    h = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+    else:
+        paths = [path]
+    for p in paths:
+        h.update(os.path.basename(p).encode() + b"\0")
+        with open(p, "rb") as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class ResultCache:
+    # The cache in directory, None disables it (every result is computed and
+    # nothing is stored).
+    def __init__(self, directory=DIRECTORY, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, digest, **params):
+        # key of the result of a tag file with the given digest, params are
+        # everything else the result depends on (reprs must be stable)
+        h = hashlib.sha256(digest.encode())
+        for name, value in sorted(params.items()):
+            h.update(f"\0{name}={value!r}".encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key, default=None):
+        if not self.directory:
+            return default
+        try:
+            with open(self.path(key), "rb") as f:
+                result = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        try:
+            os.utime(self.path(key))
+        except FileNotFoundError:
+            # removed by a concurrent trim(), the result is still valid
+            pass
+        return result
+
+    def put(self, key, result):
+        if not self.directory:
+            return
+        # write to a temporary file and rename, an existing result is complete
+        tmp = f"{self.path(key)}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path(key))
+
+    def map(self, function, jobs, keys, map=map):
+        # Results of function over jobs in order, those of cached keys loaded
+        # and the others computed with map (e.g., executor.map) and stored.
+        jobs = list(jobs)
+        missing = object()
+        results = [self.get(k, missing) for k in keys]
+        todo = [i for i, r in enumerate(results) if r is missing]
+        self.hits += len(jobs) - len(todo)
+        self.misses += len(todo)
+        for i, result in zip(todo, map(function, [jobs[i] for i in todo])):
+            self.put(keys[i], result)
+            results[i] = result
+        return results
+
+    def trim(self):
+        # removes the least recently used results over the size cap
+        if not self.directory:
+            return
+        entries = []
+        for f in os.listdir(self.directory):
+            if f.endswith(SUFFIX):
+                s = os.stat(os.path.join(self.directory, f))
+                entries.append((s.st_mtime_ns, s.st_size, f))
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, f))
+            total -= size
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+import hdf5dataset
+from classify import (
+    FOLDS,
+    dataset_path,
+    enable_cpu_fast,
+    init_fold_worker,
+    load_dataset,
+    now,
+    prefix_half,
+    run_fold,
+    stack,
+)
+
+# columns of the csv summary, in order
+COLUMNS = [
+    "group",
+    "name",
+    "dataset1",
+    "dataset2",
+    "length",
+    "open_world",
+    "fold",
+    "seed",
+    "train",
+    "valid",
+    "test",
+    "accuracy",
+    "fpr",
+    "tpr",
+    "fnr",
+    "tnr",
+    "tp",
+    "fp",
+    "fn",
+    "tn",
+    "roc_auc",
+    "average_precision",
+    "epochs",
+    "loss",
+    "seconds",
+]
+
+
+# columns of the csv of results by prefix, in order
+PREFIX_COLUMNS = ["group", "name", "fold", "cells", "per_circuit"] + COLUMNS[
+    COLUMNS.index("accuracy") : COLUMNS.index("epochs")
+]
+
+
+def stem(dataset):
+    # a dataset in experiment names, hdf5dataset specs without colons
+    if hdf5dataset.is_spec(dataset):
+        return dataset.replace(".hdf5:", "-").replace(":", "-").replace(",", "-")
+    return os.path.splitext(dataset)[0]
+
+
+def expand(matrix):
+    # Every group of the matrix is a list of dataset pairs, optionally with
+    # lengths (default [5000]) and open world probabilities (default [0.0]),
+    # and expands to one experiment per combination. Optional prefixes are
+    # the lengths (in cells) the trained models are also tested at, of each
+    # circuit of OL samples with per_circuit. Names include everything a
+    # result depends on, as results are resumed by name.
+    experiments = []
+    seed = matrix.get("seed", 0)
+    for group in matrix["experiments"]:
+        prefixes = group.get("prefixes", [])
+        per_circuit = group.get("per_circuit", False)
+        suffix = f"-s{seed}" if seed else ""
+        if prefixes:
+            suffix += f"-p{'c' if per_circuit else ''}{'-'.join(map(str, prefixes))}"
+        for dataset1, dataset2 in group["pairs"]:
+            for length in group.get("lengths", [5000]):
+                for open_world in group.get("open_world", [0.0]):
+                    stems = [stem(d) for d in (dataset1, dataset2)]
+                    experiments.append(
+                        dict(
+                            group=group["name"],
+                            name=f"{stems[0]}-{stems[1]}-l{length}-ow{open_world}{suffix}",
+                            dataset1=dataset1,
+                            dataset2=dataset2,
+                            length=length,
+                            open_world=open_world,
+                            seed=seed,
+                            prefixes=prefixes,
+                            per_circuit=per_circuit,
+                        )
+                    )
+    return experiments
+
+
+def result_path(experiment, k):
+    return os.path.join(args.output, experiment["name"], f"fold-{k}.json")
+
+
+def load(jobs):
+    # Every dataset of the jobs once per length, all datasets of a length
+    # stacked into one Samples: length -> (dataset, file -> (first sample,
+    # tags)). Forked workers share the tensors copy-on-write.
+    stores = {}
+    needed = sorted(
+        {(e["length"], f) for e, _ in jobs for f in (e["dataset1"], e["dataset2"])}
+    )
+    for length in sorted({length for length, _ in needed}):
+        samples, files, first = [], {}, 0
+        for f in [f for l, f in needed if l == length]:
+            print(f"{now()} loading {f} with {length} cells...")
+            s, tags = load_dataset(os.path.join(args.input, f), length, args.lazy)
+            files[f] = (first, tags)
+            samples.append(s)
+            first += len(s)
+        stores[length] = (stack(samples), files)
+    return stores
+
+
+def experiment_data(experiment):
+    # (dataset, index, labels, tags) of an experiment for run_fold()
+    dataset, files = stores[experiment["length"]]
+    index, labels, tags = [], [], []
+    for label, f in enumerate((experiment["dataset1"], experiment["dataset2"])):
+        first, t = files[f]
+        index.append(torch.arange(first, first + len(t)))
+        labels.append(torch.full((len(t),), label, dtype=torch.long))
+        tags.extend(t)
+    return dataset, torch.cat(index), torch.cat(labels), tags
+
+
+def half(experiment):
+    # the half of score_prefixes() for the prefixes of an experiment
+    if not experiment["prefixes"]:
+        return None
+    return prefix_half(
+        [os.path.join(args.input, experiment[d]) for d in ("dataset1", "dataset2")],
+        experiment["length"],
+        experiment["per_circuit"],
+    )
+
+
+def run_job(job):
+    experiment, k = job
+    start = time.time()
+    # checkpoint (until the result is written) and test predictions next to
+    # the results
+    fold_dir = os.path.join(args.output, experiment["name"])
+    result = run_fold(
+        experiment_data(experiment),
+        k,
+        experiment["seed"],
+        experiment["open_world"],
+        fold_dir,
+        experiment["prefixes"],
+        half(experiment),
+    )
+    result.update(experiment)
+    result.update(fold=k, seed=experiment["seed"] + k, seconds=time.time() - start)
+
+    # write to a temporary file and rename, an existing result is complete
+    p = result_path(experiment, k)
+    with open(f"{p}.tmp", "w") as f:
+        json.dump(result, f, indent=2)
+    os.replace(f"{p}.tmp", p)
+    os.remove(os.path.join(fold_dir, f"fold-{k}.pt"))
+    return job
+
+
+def summarize(experiments):
+    # all fold results of the matrix as csv, and mean and std per experiment
+    rows, prefix_rows = [], []
+    group = None
+    for experiment in experiments:
+        results = []
+        for k in range(FOLDS):
+            if os.path.exists(result_path(experiment, k)):
+                with open(result_path(experiment, k)) as f:
+                    results.append(json.load(f))
+        rows.extend(results)
+        for r in results:
+            for p in r.get("by_prefix", []):
+                prefix_rows.append(
+                    dict(p, group=r["group"], name=r["name"], fold=r["fold"])
+                )
+        if experiment["group"] != group:
+            group = experiment["group"]
+            print(f"\n{group}")
+        if len(results) < FOLDS:
+            print(f"{experiment['name']}: {len(results)} of {FOLDS} folds done")
+            continue
+        accuracy = [r["accuracy"] for r in results]
+        fpr = [r["fpr"] for r in results]
+        roc_auc = [r["roc_auc"] for r in results]
+        print(
+            f"{experiment['name']}: accuracy mean {np.mean(accuracy):.4f}, std {np.std(accuracy):.4f}, fpr mean {np.mean(fpr):.4f}, std {np.std(fpr):.4f}, roc auc mean {np.mean(roc_auc):.4f}"
+        )
+        if "by_prefix" in results[0]:
+            accuracy = np.mean(
+                [[p["accuracy"] for p in r["by_prefix"]] for r in results], axis=0
+            )
+            cells = [p["cells"] for p in results[0]["by_prefix"]]
+            print(
+                "\taccuracy mean by prefix: "
+                + ", ".join(f"{c} {a:.4f}" for c, a in zip(cells, accuracy))
+            )
+
+    p = os.path.join(args.output, "results.csv")
+    with open(p, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"\nsaved {len(rows)} fold results to {p}")
+    if prefix_rows:
+        p = os.path.join(args.output, "prefixes.csv")
+        with open(p, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=PREFIX_COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(prefix_rows)
+        print(f"saved {len(prefix_rows)} results by prefix to {p}")
+
+
+def main():
+    global stores
+    if args.cpu_fast:
+        enable_cpu_fast(args.threads)
+    with open(args.matrix) as f:
+        experiments = expand(json.load(f))
+
+    jobs = []
+    for experiment in experiments:
+        missing = [
+            d
+            for d in (experiment["dataset1"], experiment["dataset2"])
+            if not os.path.exists(dataset_path(os.path.join(args.input, d)))
+        ]
+        if missing:
+            print(f"{now()} skipping {experiment['name']}, {missing[0]} does not exist")
+            continue
+        try:
+            half(experiment)
+        except ValueError as e:
+            print(f"{now()} skipping {experiment['name']}, {e}")
+            continue
+        for k in range(FOLDS):
+            if not os.path.exists(result_path(experiment, k)):
+                jobs.append((experiment, k))
+    print(
+        f"{now()} {len(experiments)} experiments, {len(jobs)} of {len(experiments) * FOLDS} folds to run"
+    )
+
+    if jobs:
+        stores = load(jobs)
+        if torch.cuda.is_available():
+            # forking after CUDA init is unsafe, and jobs would share one GPU
+            print(f"{now()} using {torch.cuda.get_device_name(0)}")
+            for job in tqdm(jobs, unit="fold"):
+                run_job(job)
+        else:
+            print(
+                f"{now()} running {args.workers} folds at a time, {args.threads} threads each"
+            )
+            with ProcessPoolExecutor(
+                max_workers=args.workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=init_fold_worker,
+                initargs=(args.threads,),
+            ) as executor:
+                futures = [executor.submit(run_job, job) for job in jobs]
+                for future in tqdm(as_completed(futures), total=len(jobs), unit="fold"):
+                    future.result()
+
+    summarize(experiments)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a matrix of binary-classify experiments, resumable"
+    )
+    parser.add_argument(
+        "matrix",
+        nargs="?",
+        default="experiments.json",
+        help="json file with the experiment matrix",
+    )
+    parser.add_argument(
+        "-i", "--input", default=".", help="directory with the datasets"
+    )
+    parser.add_argument(
+        "-o", "--output", default="results", help="directory for the results"
+    )
+    parser.add_argument(
+        "-t", "--threads", type=int, default=4, help="torch threads per fold"
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=None,
+        help="folds to run at a time (default: cores / threads)",
+    )
+    parser.add_argument(
+        "--cpu-fast",
+        action="store_true",
+        help="torch.compile, bfloat16 autocast where supported and explicit threads",
+    )
+    parser.add_argument(
+        "--lazy",
+        action="store_true",
+        help="read FILE.hdf5:DATASET:KINDS datasets block by block while training, not into memory",
+    )
+    args = parser.parse_args()
+    if args.workers is None:
+        args.workers = max(1, os.cpu_count() // args.threads)
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+import tracefile
+from classify import LOAD_CHUNK, autocast, enable_cpu_fast, fit, load_model, now
+
+
+def trace_files(paths):
+    # the trace files of paths, directories expanded (not recursively)
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(f for f in os.listdir(path) if f.endswith(".npz"))
+            candidates = [os.path.join(path, f) for f in names]
+        else:
+            candidates = [path]
+        for f in candidates:
+            if tracefile.is_trace_file(f):
+                files.append(f)
+            else:
+                print(f"{now()} skipping {f}, not a trace file")
+    return files
+
+
+def score(model, x, device):
+    # class probabilities of int8 (n, length) traces, batch by batch
+    probabilities = []
+    with torch.inference_mode(), autocast(device):
+        for start in range(0, len(x), args.batch_size):
+            batch = x[start : start + args.batch_size].to(device)
+            outputs = model(batch.unsqueeze(1).float()).float()
+            probabilities.append(F.softmax(outputs, dim=1).cpu())
+    return torch.cat(probabilities).numpy()
+
+
+def main():
+    if args.cpu_fast:
+        enable_cpu_fast(args.threads)
+    elif args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+    model, saved = load_model(args.model, device)
+    length, classes = saved["length"], saved["classes"]
+    print(f"{now()} loaded {args.model}, DF with {length} cells, classes {classes}")
+
+    files = trace_files(args.inputs)
+    total = sum(len(tracefile.TraceFile(f)) for f in files)
+    print(f"{now()} scoring {total} traces in {len(files)} files")
+
+    with open(args.output, "w", newline="") as out, tqdm(
+        total=total, unit="trace"
+    ) as progress:
+        writer = csv.writer(out)
+        writer.writerow(["file", "sample", "id", "tag"] + classes)
+        for f in files:
+            tf = tracefile.TraceFile(f)
+            for start in range(0, len(tf), LOAD_CHUNK):
+                end = min(start + LOAD_CHUNK, len(tf))
+                x = torch.from_numpy(fit(tf.get(np.arange(start, end)), length))
+                p = score(model, x, device)
+                ids = tf.ids[start:end] if tf.ids is not None else [""] * (end - start)
+                writer.writerows(
+                    [f, i, id, tag] + [f"{q:.6f}" for q in row]
+                    for i, id, tag, row in zip(
+                        range(start, end), ids, tf.tags[start:end], p
+                    )
+                )
+                progress.update(end - start)
+    print(f"{now()} saved {total} scores to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score trace files with a model saved by binary-classify.py --save-model"
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="trace files or directories with trace files"
+    )
+    parser.add_argument("-m", "--model", required=True, help="saved model")
+    parser.add_argument(
+        "-o", "--output", default="scores.csv", help="csv with the probabilities"
+    )
+    parser.add_argument(
+        "-b", "--batch-size", type=int, default=1024, help="traces per forward pass"
+    )
+    parser.add_argument(
+        "--cpu-fast",
+        action="store_true",
+        help="bfloat16 autocast where supported and explicit threads",
+    )
+    parser.add_argument("-t", "--threads", type=int, default=None, help="torch threads")
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import os
+import socket
+import sys
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from classify import autocast, enable_cpu_fast, load_model, now
+from traces import DROPPED_CELL
+
+# Classifies circuits while their cells arrive, with a model saved by
+# binary-classify.py --save-model. Reads the cell events of replay-circuits.py
+# from stdin (e.g., a pipe) or a unix socket. A circuit is scored every
+# --every cells, when it has the model's length in cells and when it closes,
+# all circuits due after a read in one batched forward pass. A decision is
+# emitted once a class has probability --confidence, or at the latest when
+# the trace is complete (full or closed).
+
+
+class Buffers:
+    # The trace so far of every open circuit, its first length cells as in
+    # featurize(), in a preallocated int8 array with one row (slot) per
+    # circuit. Slots are reused after release, the array doubles when all
+    # slots are taken.
+    def __init__(self, length, slots=1024):
+        self.traces = np.zeros((slots, length), dtype=np.int8)
+        self.fill = [0] * slots
+        self.free = list(range(slots - 1, -1, -1))
+        self.slot = {}
+
+    def add(self, circuit, direction):
+        # appends a cell (beyond length, only counts it), returns the slot
+        # and the number of cells of the circuit
+        slot = self.slot.get(circuit)
+        if slot is None:
+            if not self.free:
+                self.grow()
+            slot = self.slot[circuit] = self.free.pop()
+        n = self.fill[slot]
+        if n < self.traces.shape[1]:
+            self.traces[slot, n] = direction
+        self.fill[slot] = n + 1
+        return slot, n + 1
+
+    def grow(self):
+        slots = len(self.fill)
+        self.traces = np.concatenate((self.traces, np.zeros_like(self.traces)))
+        self.fill.extend([0] * slots)
+        self.free.extend(range(2 * slots - 1, slots - 1, -1))
+
+    def release(self, circuit):
+        slot = self.slot.pop(circuit)
+        self.traces[slot] = 0
+        self.fill[slot] = 0
+        self.free.append(slot)
+
+
+def reads(read):
+    # (complete lines, arrival time) of every read from the stream
+    rest = b""
+    while True:
+        data = read(1 << 16)
+        if not data:
+            return
+        t = time.perf_counter()
+        lines = (rest + data).split(b"\n")
+        rest = lines.pop()
+        yield lines, t
+
+
+def score(model, x, device):
+    # class probabilities of int8 (n, length) traces
+    probabilities = []
+    with torch.inference_mode(), autocast(device):
+        for start in range(0, len(x), args.batch_size):
+            batch = x[start : start + args.batch_size].to(device)
+            outputs = model(batch.unsqueeze(1).float()).float()
+            probabilities.append(F.softmax(outputs, dim=1).cpu())
+    return torch.cat(probabilities).numpy()
+
+
+def main():
+    if args.cpu_fast:
+        enable_cpu_fast(args.threads)
+    elif args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model, saved = load_model(args.model, device)
+    length, classes = saved["length"], saved["classes"]
+    print(
+        f"{now()} loaded {args.model}, DF with {length} cells, classes {classes}",
+        file=sys.stderr,
+    )
+    if saved.get("circuit_width"):
+        # OL models score a general and a rend circuit side by side, and the
+        # stream has one circuit at a time
+        print(
+            f"{now()} {args.model} is trained on samples of two circuits, not single circuits",
+            file=sys.stderr,
+        )
+        return
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(args.socket)
+        server.listen(1)
+        print(f"{now()} waiting on {args.socket}...", file=sys.stderr)
+        connection, _ = server.accept()
+        read = connection.recv
+    else:
+        read = lambda n: os.read(sys.stdin.fileno(), n)
+
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(["circuit", "cells", "reason", "class"] + classes + ["latency_ms"])
+
+    buffers = Buffers(length)
+    # circuits to score after this read -> why, and the arrival time of their
+    # last event
+    due, arrival = {}, {}
+    # circuits with a decision that are still open, their cells are ignored
+    decided = set()
+    events, forwards, scored, malformed = 0, 0, 0, 0
+    cells, latencies, reasons = [], [], {}
+    # (cells, class) of the decisions by the input of replay-circuits.py
+    by_source = {}
+    start = None
+    for lines, t in reads(read):
+        start = start or t
+        events += len(lines)
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 2:
+                malformed += len(fields)
+                continue
+            circuit = fields[0]
+            if fields[1] == b"close":
+                if circuit in decided:
+                    decided.discard(circuit)
+                elif circuit in buffers.slot:
+                    due[circuit] = "close"
+                    arrival[circuit] = t
+                continue
+            try:
+                direction, command = int(fields[1]), int(fields[2])
+            except (IndexError, ValueError):
+                malformed += 1
+                continue
+            if circuit in decided or command == DROPPED_CELL:
+                continue
+            _, n = buffers.add(circuit, direction)
+            arrival[circuit] = t
+            if n == length:
+                due[circuit] = "full"
+            elif n % args.every == 0:
+                due.setdefault(circuit, "every")
+        if not due:
+            continue
+
+        circuits = list(due)
+        slots = [buffers.slot[c] for c in circuits]
+        p = score(model, torch.from_numpy(buffers.traces[slots]), device)
+        forwards += 1
+        scored += len(circuits)
+        done = time.perf_counter()
+        for circuit, slot, q in zip(circuits, slots, p):
+            reason = due[circuit]
+            if reason == "every":
+                if q.max() < args.confidence:
+                    continue
+                reason = "confident"
+            n = min(buffers.fill[slot], length)
+            latency = (done - arrival[circuit]) * 1000
+            writer.writerow(
+                [circuit.decode(), n, reason, classes[q.argmax()]]
+                + [f"{x:.6f}" for x in q]
+                + [f"{latency:.3f}"]
+            )
+            cells.append(n)
+            latencies.append(latency)
+            reasons[reason] = reasons.get(reason, 0) + 1
+            source = circuit.decode().split("/")[0]
+            by_source.setdefault(source, []).append((n, q.argmax()))
+            buffers.release(circuit)
+            del arrival[circuit]
+            if reason != "close":
+                decided.add(circuit)
+        due.clear()
+    out.flush()
+
+    if malformed:
+        print(f"{now()} skipped {malformed} malformed lines", file=sys.stderr)
+    if start is None:
+        print(f"{now()} no events", file=sys.stderr)
+        return
+    seconds = time.perf_counter() - start
+    print(
+        f"{now()} {events} events in {seconds:.1f}s, {events / seconds:.0f} events/s, {forwards} forward passes of {scored / max(forwards, 1):.1f} traces on average",
+        file=sys.stderr,
+    )
+    if latencies:
+        print(
+            f"{now()} {len(cells)} decisions {reasons}, cells mean {np.mean(cells):.1f}, median {np.median(cells):.0f}, latency ms p50 {np.percentile(latencies, 50):.2f}, p99 {np.percentile(latencies, 99):.2f}",
+            file=sys.stderr,
+        )
+    for source, decisions in sorted(by_source.items()):
+        n, c = np.array(decisions).T
+        shares = ", ".join(
+            f"{name} {np.mean(c == i):.4f}" for i, name in enumerate(classes)
+        )
+        print(
+            f"{now()} {source}: {len(n)} decisions, {shares}, cells mean {n.mean():.1f}",
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Classify circuits from a stream of cell events"
+    )
+    parser.add_argument("-m", "--model", required=True, help="saved model")
+    parser.add_argument(
+        "-s",
+        "--socket",
+        default=None,
+        help="listen on this unix socket (default: read stdin)",
+    )
+    parser.add_argument(
+        "-o", "--output", default=None, help="csv of decisions (default: stdout)"
+    )
+    parser.add_argument(
+        "-k", "--every", type=int, default=100, help="score a circuit every k cells"
+    )
+    parser.add_argument(
+        "-c",
+        "--confidence",
+        type=float,
+        default=0.9,
+        help="probability for an early decision",
+    )
+    parser.add_argument(
+        "-b", "--batch-size", type=int, default=1024, help="traces per forward pass"
+    )
+    parser.add_argument(
+        "--cpu-fast",
+        action="store_true",
+        help="bfloat16 autocast where supported and explicit threads",
+    )
+    parser.add_argument("-t", "--threads", type=int, default=None, help="torch threads")
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,123 @@
+import struct
+import zipfile
+import numpy as np
+
+# A trace file is an uncompressed .npz with only plain npy members, so it loads
+# without pickle and every member can be memory-mapped:
+#
+#   traces   uint8 (rows, ceil(width / 4)), cell directions packed 2 bits each
+#   width    number of cells per row
+#   lengths  int32 (rows,), non-zero cells per row
+#   tags     (samples,) tag of every sample
+#   ids      optional (samples,) unique id of every sample
+#   pairs    optional int32 (samples, 2): sample i is row pairs[i, 0] followed
+#            by row pairs[i, 1], otherwise sample i is row i
+#   circuit_width
+#            optional cells per circuit if every sample is two circuits side
+#            by side (OL samples, general then rend), else one circuit
+#
+# Directions are -1, 0 and 1, stored as their two lowest bits (3, 0 and 1).
+_UNPACK = np.array(
+    [[[0, 1, 0, -1][(b >> (2 * i)) & 3] for i in range(4)] for b in range(256)],
+    dtype=np.int8,
+)
+
+
+def pack(traces):
+    # (n, width) directions -> (n, ceil(width / 4)) uint8
+    traces = np.asarray(traces, dtype=np.int8)
+    n, width = traces.shape
+    codes = np.zeros((n, -(-width // 4) * 4), dtype=np.uint8)
+    codes[:, :width] = traces.view(np.uint8) & 3
+    codes = codes.reshape(n, codes.shape[1] // 4, 4)
+    return (
+        codes[:, :, 0] | codes[:, :, 1] << 2 | codes[:, :, 2] << 4 | codes[:, :, 3] << 6
+    )
+
+
+def unpack(packed, width):
+    # (n, ceil(width / 4)) uint8 -> (n, width) int8 directions
+    return _UNPACK[packed].reshape(len(packed), packed.shape[1] * 4)[:, :width]
+
+
+def save(path, traces, tags, ids=None, pairs=None, circuit_width=None):
+    members = dict(
+        traces=pack(traces),
+        width=np.array(traces.shape[1]),
+        lengths=np.count_nonzero(traces, axis=1).astype(np.int32),
+        tags=np.asarray(tags),
+    )
+    if ids is not None:
+        members["ids"] = np.asarray(ids, dtype=str)
+    if pairs is not None:
+        members["pairs"] = np.asarray(pairs, dtype=np.int32).reshape(-1, 2)
+    if circuit_width is not None:
+        members["circuit_width"] = np.array(circuit_width)
+    np.savez(path, **members)
+
+
+def _member(path, zf, name):
+    # memory-map a stored (uncompressed) npy member, read it otherwise
+    info = zf.getinfo(f"{name}.npy")
+    if info.compress_type == zipfile.ZIP_STORED:
+        with open(path, "rb") as f:
+            # skip the local file header, its name and extra fields
+            f.seek(info.header_offset + 26)
+            name_len, extra_len = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            if len(shape) > 0 and 0 not in shape and not dtype.hasobject:
+                return np.memmap(
+                    path,
+                    dtype=dtype,
+                    mode="r",
+                    offset=f.tell(),
+                    shape=shape,
+                    order="F" if fortran_order else "C",
+                )
+    with zf.open(info) as f:
+        return np.lib.format.read_array(f, allow_pickle=False)
+
+
+class TraceFile:
+    def __init__(self, path):
+        with zipfile.ZipFile(path) as zf:
+            names = [n[:-4] for n in zf.namelist()]
+            m = {name: _member(path, zf, name) for name in names}
+        self.traces = m["traces"]
+        self.width = int(m["width"])
+        self.lengths = m["lengths"]
+        self.tags = m["tags"]
+        self.ids = m.get("ids")
+        self.pairs = m.get("pairs")
+        self.circuit_width = int(m["circuit_width"]) if "circuit_width" in m else None
+
+    def __len__(self):
+        return len(self.tags)
+
+    def sample_width(self):
+        return 2 * self.width if self.pairs is not None else self.width
+
+    def get(self, index):
+        # int8 (len(index), sample_width()) samples
+        index = np.asarray(index)
+        if self.pairs is None:
+            return unpack(self.traces[index], self.width)
+        p = self.pairs[index]
+        return np.concatenate(
+            (
+                unpack(self.traces[p[:, 0]], self.width),
+                unpack(self.traces[p[:, 1]], self.width),
+            ),
+            axis=1,
+        )
+
+
+def is_trace_file(path):
+    with zipfile.ZipFile(path) as zf:
+        return "width.npy" in zf.namelist()
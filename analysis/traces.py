@@ -0,0 +1,116 @@
+import numpy as np
+
+# DF trace representation length
+LENGTH = 5000
+
+KIND_GENERAL = 0
+KIND_HSDIR = 1
+KIND_INTRO = 2
+KIND_REND = 3
+
+FILTERED_DOMAINS = [
+    b"securedrop.org",
+    b"185.220.103.112",
+    b"185.220.103.119",
+]
+
+CF_DOMAINS = [
+    b"cflaresuje2rb7w2u3w43pn4luxdi6o7oatv6r2zrfb5xvsugj35d2qd.onion",
+    b"cflarexljc3rw355ysrkrzwapozws6nre6xsy3n4yrj7taye3uiby3ad.onion",
+    b"cflarenuttlfuyn7imozr4atzvfbiw3ezgbdjdldmdx7srterayaozid.onion",
+    b"cflareki4v3lh674hq55k3n7xd4ibkwx3pnw67rr3gkpsonjmxbktxyd.onion",
+    b"cflareub6dtu7nvs3kqmoigcjdwap2azrkx5zohb2yk7gqjkwoyotwqd.onion",
+    b"cflareusni3s7vwhq2f7gc4opsik7aa4t2ajedhzr42ez6uajaywh3qd.onion",
+    b"cflareer7qekzp3zeyqvcfktxfrmncse4ilc7trbf6bp6yzdabxuload.onion",
+    b"cflares35lvdlczhy3r6qbza5jjxbcplzvdveabhf7bsp7y4nzmn67yd.onion",
+    b"cflarejlah424meosswvaeqzb54rtdetr4xva6mq2bm2hfcx5isaglid.onion",
+    b"cflare2nge4h4yqr3574crrd7k66lil3torzbisz6uciyuzqc2h2ykyd.onion",
+    b"cloudflare.com",
+]
+
+# relay command of cells that mark a directory circuit
+RELAY_BEGIN_DIR = 13
+# cells with this value in their fourth field are dropped from traces
+DROPPED_CELL = 16
+
+
+def _positions(counts):
+    # for groups of the given sizes laid out back to back: the group of every
+    # element and its position within the group
+    group = np.repeat(np.arange(len(counts)), counts)
+    first = np.cumsum(counts) - counts
+    return group, np.arange(len(group)) - first[group]
+
+
+def gather_cells(circuits):
+    # all cells of all circuits, and for every cell the circuit it belongs to
+    lengths = circuits.lengths()
+    cid, pos = _positions(lengths)
+    if len(cid) == 0:
+        return circuits.cells[:0], cid
+    return circuits.cells[circuits.starts[cid] + pos], cid
+
+
+def featurize(circuits, length=LENGTH):
+    # Returns DF traces of shape (n, length) for n circuits, row i identical
+    # to cells2df(cells[cell[3] != 16], length) of circuit i, and whether each
+    # circuit is a directory circuit. Computed for all circuits at once.
+    n = len(circuits)
+    cells, cid = gather_cells(circuits)
+    is_dir = _is_dir(cells, cid, n)
+
+    keep = cells[cells.dtype.names[3]] != DROPPED_CELL
+    kept_cid = cid[keep]
+    _, pos = _positions(np.bincount(kept_cid, minlength=n))
+    inside = pos < length
+
+    traces = np.zeros((n, length), dtype=np.float32)
+    traces[kept_cid[inside], pos[inside]] = cells["direction"][keep][inside]
+    return traces, is_dir
+
+
+def _is_dir(cells, cid, n):
+    return np.bincount(cid[cells["relay_cmd"] == RELAY_BEGIN_DIR], minlength=n) > 0
+
+
+def count_cells(circuits):
+    # The number of cells of every circuit that featurize() puts in traces,
+    # and whether each circuit is a directory circuit, without building the
+    # traces. With directions of +-1, a trace of length cells has
+    # min(count, length) non-zero cells, see trace_lengths().
+    n = len(circuits)
+    cells, cid = gather_cells(circuits)
+    keep = cells[cells.dtype.names[3]] != DROPPED_CELL
+    return np.bincount(cid[keep], minlength=n), _is_dir(cells, cid, n)
+
+
+def trace_lengths(traces):
+    # number of non-zero cells of each trace (row)
+    return np.count_nonzero(traces, axis=1)
+
+
+def largest_trace(traces):
+    # the first trace with the most non-zero cells as a (1, length) view, and
+    # its number of non-zero cells
+    lengths = trace_lengths(traces)
+    i = np.argmax(lengths)
+    return traces[i : i + 1], lengths[i]
+
+
+def group_by(key, *arrays):
+    # Yields (value, *views) for every distinct value of key in ascending
+    # order, where the views are the rows of arrays (anything indexable by
+    # slices and index arrays, e.g. Circuits) that have that key, in their
+    # original order. The arrays are reordered at most once, and not at all if
+    # key is already sorted, so the views are slices without copies.
+    key = np.asarray(key)
+    if len(key) > 1 and np.any(key[1:] < key[:-1]):
+        order = np.argsort(key, kind="stable")
+        key = key[order]
+        arrays = [a[order] for a in arrays]
+    bounds = np.flatnonzero(key[1:] != key[:-1]) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(key)]))
+    for start, end in zip(starts, ends):
+        if end > start:
+            yield (key[start],) + tuple(a[start:end] for a in arrays)
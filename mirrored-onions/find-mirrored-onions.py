@@ -1,11 +1,31 @@
 #!/usr/bin/env python3
 import argparse
 import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import Levenshtein
+import numpy as np
+from tqdm import tqdm
 
 MIN_SIMILARITY = 0.9
 MIN_SIZE = 512
 
+# --lsh: pages are sets of SHINGLE-byte shingles, with MinHash signatures of
+# NUM_PERM hashes split into --bands bands. Pages with an identical band are
+# candidates, found with probability 1 - (1 - j^r)^bands for jaccard
+# similarity j and r = NUM_PERM / bands rows per band (by default, above 0.99
+# from j = 0.3, and mirrors by Levenshtein ratio mostly have j above 0.45).
+SHINGLE = 5
+NUM_PERM = 128
+BANDS = 64
+# shingles hashed at a time, bounds the memory of signature()
+SHINGLE_CHUNK = 8192
+# permutation k of the MinHash is the multiply-shift hash (PERM_A[k] *
+# shingle + PERM_B[k]) >> 32 of a shingle as a uint64
+_rng = np.random.default_rng(0)
+PERM_A = _rng.integers(0, 2**63, NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+PERM_B = _rng.integers(0, 2**63, NUM_PERM, dtype=np.uint64)
+
 def main():
     work = []
     with open(args.list, "r") as f:
@@ -21,49 +41,185 @@ def main():
     total_urls = sum(len(urls) for _, _, urls in work)
     print(f"with {total_urls} clearnet URLs")
 
-    mirrored = []
-    for (n, onion, urls) in work:
-        folder = os.path.join(args.output, str(n))
-        onion_file = os.path.join(folder, "onion")
-        if not os.path.exists(onion_file) or os.path.getsize(onion_file) < MIN_SIZE:
-            continue
+    if args.lsh:
+        find_clusters(work)
+        return
 
-        o = "empty"
-        try:
-            o = open(onion_file).read().strip()
-        except:
-            print(f"ERROR reading onion file {onion_file}")
-            continue
+    # onions are matched in parallel, results (and errors) in list order
+    mirrored = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for (onion, matches, errors) in tqdm(executor.map(worker, work, chunksize=8), total=len(work)):
+            for error in errors:
+                print(error)
+            if len(matches) > 0:
+                mirrored.append((onion, matches))
 
-        matches = []
-        for (i, url) in enumerate(urls):
-            url_file = os.path.join(folder, str(i))
-            if not os.path.exists(url_file) or os.path.getsize(url_file) < MIN_SIZE:
-                continue
-            
-            try:
-                u = open(url_file).read().strip()
-                if strings_are_similar(o, u):
-                    matches.append(url)
-            except:
-                print(f"ERROR reading url file {url_file}")
-                continue
-        
-        if len(matches) > 0:
-            mirrored.append((onion, matches))
-    
     print(f"found {len(mirrored)} mirrored onions")
     for (onion, matches) in mirrored:
         # matches is now a list, turn it into a string with spaces
         m = " ".join(matches)
         print(f"{onion} {m}")
 
-def strings_are_similar(str1, str2, threshold=MIN_SIMILARITY):
-    return Levenshtein.ratio(str1, str2) >= threshold
+def worker(job):
+    n, onion, urls = job
+    return match_onion(n, onion, urls)
+
+def match_onion(n, onion, urls):
+    # (onion, matching urls, error messages) of one onion
+    folder = os.path.join(args.output, str(n))
+    onion_file = os.path.join(folder, "onion")
+    if not os.path.exists(onion_file) or os.path.getsize(onion_file) < MIN_SIZE:
+        return onion, [], []
+
+    o = "empty"
+    try:
+        o = open(onion_file).read().strip()
+    except:
+        return onion, [], [f"ERROR reading onion file {onion_file}"]
+
+    matches, errors = [], []
+    o_histogram = None
+    for (i, url) in enumerate(urls):
+        url_file = os.path.join(folder, str(i))
+        if not os.path.exists(url_file) or os.path.getsize(url_file) < MIN_SIZE:
+            continue
+
+        try:
+            u = open(url_file).read().strip()
+            if o_histogram is None:
+                o_histogram = Counter(o)
+            if strings_are_similar(o, u, histogram1=o_histogram):
+                matches.append(url)
+        except:
+            errors.append(f"ERROR reading url file {url_file}")
+            continue
+
+    return onion, matches, errors
+
+def strings_are_similar(str1, str2, threshold=MIN_SIMILARITY, histogram1=None):
+    # Levenshtein.ratio(str1, str2) >= threshold. The ratio is 1 - d / (len1 +
+    # len2) for the indel distance d, which is at least the difference of the
+    # lengths and at least the sum of the differences of the character counts,
+    # so these bounds reject most pairs in linear time. The ratio of the rest
+    # stops early below the cutoff (and returns 0), and is exact otherwise.
+    # Ratios are multiples of 1 / (len1 + len2), bounds and cutoff are one
+    # step below the threshold so that float rounding never rejects a pair.
+    total = len(str1) + len(str2)
+    if total == 0:
+        return Levenshtein.ratio(str1, str2) >= threshold
+    cutoff = max(threshold - 1 / total, 0)
+    if 2 * min(len(str1), len(str2)) / total < cutoff:
+        return False
+    if histogram1 is None:
+        histogram1 = Counter(str1)
+    common = sum((histogram1 & Counter(str2)).values())
+    if 2 * common / total < cutoff:
+        return False
+    return Levenshtein.ratio(str1, str2, score_cutoff=cutoff) >= threshold
+
+def find_clusters(work):
+    # Clusters of mirrored pages among all fetched pages of at least MIN_SIZE
+    # bytes: candidates from an LSH index of MinHash signatures, confirmed
+    # with strings_are_similar(), clusters are the connected pages. Only
+    # clusters with an onion are reported.
+    pages = []
+    for (n, onion, urls) in work:
+        folder = os.path.join(args.output, str(n))
+        files = [(onion, "onion")] + [(url, str(i)) for (i, url) in enumerate(urls)]
+        for (name, f) in files:
+            path = os.path.join(folder, f)
+            if os.path.exists(path) and os.path.getsize(path) >= MIN_SIZE:
+                pages.append((name, path, f == "onion"))
+    print(f"indexing {len(pages)} pages")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        signatures = list(tqdm(executor.map(signature, [p for (_, p, _) in pages], chunksize=8), total=len(pages)))
+        for ((_, path, _), s) in zip(pages, signatures):
+            if s is None:
+                print(f"ERROR reading file {path}")
+        indexed = [i for (i, s) in enumerate(signatures) if s is not None]
+        matrix = np.array([signatures[i] for i in indexed], dtype=np.uint32).reshape(-1, NUM_PERM)
+        candidates = sorted((indexed[a], indexed[b]) for (a, b) in lsh_candidates(matrix))
+        print(f"confirming {len(candidates)} candidate pairs")
+        jobs = [(pages[a][1], pages[b][1]) for (a, b) in candidates]
+        similar = list(tqdm(executor.map(confirm, jobs, chunksize=8), total=len(jobs)))
+
+    # union-find over the confirmed pairs
+    parent = list(range(len(pages)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for ((a, b), ok) in zip(candidates, similar):
+        if ok:
+            parent[find(b)] = find(a)
+    clusters = {}
+    for i in range(len(pages)):
+        clusters.setdefault(find(i), []).append(i)
+    clusters = [c for c in clusters.values() if len(c) > 1 and any(pages[i][2] for i in c)]
+
+    print(f"found {len(clusters)} clusters of mirrored pages")
+    for c in clusters:
+        # onions first, every name once
+        names = [pages[i][0] for i in c if pages[i][2]] + [pages[i][0] for i in c if not pages[i][2]]
+        print(" ".join(dict.fromkeys(names)))
+
+def signature(path):
+    # MinHash signature (NUM_PERM uint32) of the shingles of a page, None if
+    # it cannot be read
+    try:
+        data = open(path).read().strip().encode()
+    except:
+        return None
+    if len(data) < SHINGLE:
+        data = data.ljust(SHINGLE, b"\0")
+    # the bytes of every shingle packed in a uint64
+    raw = np.frombuffer(data, dtype=np.uint8).astype(np.uint64)
+    n = len(raw) - SHINGLE + 1
+    shingles = np.zeros(n, dtype=np.uint64)
+    for k in range(SHINGLE):
+        shingles |= raw[k : k + n] << np.uint64(8 * k)
+    shingles = np.unique(shingles)
+    minimum = np.full(NUM_PERM, np.iinfo(np.uint32).max, dtype=np.uint32)
+    for start in range(0, len(shingles), SHINGLE_CHUNK):
+        x = shingles[start : start + SHINGLE_CHUNK, None]
+        h = ((x * PERM_A + PERM_B) >> np.uint64(32)).astype(np.uint32)
+        np.minimum(minimum, h.min(axis=0), out=minimum)
+    return minimum
+
+def lsh_candidates(signatures):
+    # pairs (i, j), i < j, of pages with an identical band, each page paired
+    # only with the first page of every bucket it is in (linear in the
+    # number of pages, clusters are connected through the first pages)
+    rows = NUM_PERM // args.bands
+    candidates = set()
+    if len(signatures) == 0:
+        return candidates
+    for band in range(args.bands):
+        keys = signatures[:, band * rows : (band + 1) * rows]
+        _, bucket = np.unique(keys, axis=0, return_inverse=True)
+        bucket = bucket.ravel()
+        order = np.argsort(bucket, kind="stable")
+        bounds = np.flatnonzero(np.diff(bucket[order])) + 1
+        for members in np.split(order, bounds):
+            first = members[0]
+            candidates.update((int(first), int(j)) for j in members[1:])
+    return candidates
+
+def confirm(pair):
+    # strings_are_similar() of two pages
+    try:
+        return strings_are_similar(open(pair[0]).read().strip(), open(pair[1]).read().strip())
+    except:
+        return False
 
 parser = argparse.ArgumentParser(description="Visit onion frontpage")
 parser.add_argument("-l", "--list", required=True, help="list of urls to visit")
 parser.add_argument("-o", "--output", required=True, help="output folder")
+parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="number of workers")
+parser.add_argument("--lsh", action="store_true", help="find mirrors among all fetched pages, not only the listed pairs")
+parser.add_argument("-b", "--bands", type=int, default=BANDS, choices=[b for b in range(1, NUM_PERM + 1) if NUM_PERM % b == 0], help="LSH bands with --lsh, more find less similar candidates")
 args = parser.parse_args()
 
 if __name__ == "__main__":